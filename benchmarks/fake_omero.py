@@ -0,0 +1,344 @@
+"""
+An in-memory stand-in for the parts of `BlitzGateway` (and what ezomero
+calls on it) that `generate_xml.py` and `generate_omero_objects.py` use,
+so both can run without an OMERO server.
+
+Data lives in a plain dict made by `create_store` (empty, for a
+destination) or `make_project` (a synthetic source Project). Model
+objects are real `omero.model` objects, so the code under test sees the
+same types it gets from a server. Every service call sleeps for
+`latency` seconds and is counted per method in `FakeGateway.calls`.
+`make_pool` builds the equivalent of `omero_pool.open_pool` out of fake
+gateways sharing a store.
+
+Only the queries the transfer code actually sends are understood; any
+other query raises NotImplementedError.
+"""
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from omero.gateway import ServiceOptsDict
+from omero.model import ImageI, RoiI, PolygonI, NamedValue
+from omero.model import TagAnnotationI, MapAnnotationI
+from omero.rtypes import rlong, rstring, rint, unwrap, wrap
+
+
+def create_store():
+    return {'projects': {}, 'datasets': {}, 'images': {}, 'annotations': {},
+            'rois': {}, 'links': {}, 'saved': [], 'next_id': 1}
+
+
+def _new_id(store):
+    new_id = store['next_id']
+    store['next_id'] += 1
+    return new_id
+
+
+def _polygon(n_vertices, offset):
+    shape = PolygonI()
+    points = " ".join(f"{offset + i},{offset + (i * 7) % n_vertices}"
+                      for i in range(n_vertices))
+    shape.setPoints(rstring(points))
+    shape.setTheZ(rint(0))
+    shape.setTheC(rint(0))
+    shape.setTheT(rint(0))
+    return shape
+
+
+def make_project(n_datasets=2, images_per_dataset=10, n_tags=10, n_maps=10,
+                 rois_per_image=10, shapes_per_roi=1, n_vertices=8):
+    """
+    Synthetic source data: one Project with `n_datasets` Datasets of
+    `images_per_dataset` Images each. Tags and MapAnnotations are
+    shared round-robin by the Images (and the Project/Datasets), and
+    every Image has `rois_per_image` ROIs with `shapes_per_roi`
+    polygons. Returns (store, project ID).
+    """
+    store = create_store()
+    links = store['links']
+    for link_type in ['ProjectDatasetLink', 'DatasetImageLink',
+                      'ProjectAnnotationLink', 'DatasetAnnotationLink',
+                      'ImageAnnotationLink', 'RoiAnnotationLink']:
+        links[link_type] = []
+    ann_ids = []
+    for i in range(n_tags):
+        tag = TagAnnotationI(_new_id(store), True)
+        tag.setTextValue(rstring(f"tag {i}"))
+        if i % 2:
+            tag.setDescription(rstring(f"description of tag {i}"))
+            tag.setNs(rstring("example.org/tags"))
+        store['annotations'][tag.getId().val] = tag
+        ann_ids.append(tag.getId().val)
+    for i in range(n_maps):
+        kv = MapAnnotationI(_new_id(store), True)
+        kv.setNs(rstring("openmicroscopy.org/omero/client/mapAnnotation"))
+        kv.setMapValue([NamedValue("key", f"value {i}"),
+                        NamedValue("index", str(i))])
+        store['annotations'][kv.getId().val] = kv
+        ann_ids.append(kv.getId().val)
+
+    def annotate(link_type, parent_id, n):
+        if ann_ids:
+            links[link_type].append((parent_id, ann_ids[n % len(ann_ids)]))
+
+    proj_id = _new_id(store)
+    store['projects'][proj_id] = ("Synthetic project", "benchmark data")
+    annotate('ProjectAnnotationLink', proj_id, 0)
+    n_img = 0
+    for d in range(n_datasets):
+        ds_id = _new_id(store)
+        store['datasets'][ds_id] = (f"dataset {d}", None)
+        links['ProjectDatasetLink'].append((proj_id, ds_id))
+        annotate('DatasetAnnotationLink', ds_id, d)
+        for _ in range(images_per_dataset):
+            img_id = _new_id(store)
+            store['images'][img_id] = (f"image {n_img}.tif", None)
+            links['DatasetImageLink'].append((ds_id, img_id))
+            annotate('ImageAnnotationLink', img_id, n_img)
+            if n_maps:
+                annotate('ImageAnnotationLink', img_id, n_tags +
+                         n_img % n_maps)
+            rois = []
+            for r in range(rois_per_image):
+                roi = RoiI(_new_id(store), True)
+                roi.setImage(ImageI(img_id, False))
+                for s in range(shapes_per_roi):
+                    shape = _polygon(n_vertices, r + s)
+                    shape.setId(rlong(_new_id(store)))
+                    roi.addShape(shape)
+                rois.append(roi)
+            store['rois'][img_id] = rois
+            n_img += 1
+    return store, proj_id
+
+
+def add_images(store, n):
+    # destination-side stand-ins for imported images; returns their IDs
+    ids = []
+    for i in range(n):
+        img_id = _new_id(store)
+        store['images'][img_id] = (f"imported {i}", None)
+        ids.append(img_id)
+    return ids
+
+
+class _Value:
+    # enumeration wrappers (dimension order, pixel type) as gateway returns
+    def __init__(self, value):
+        self._value = value
+
+    def getValue(self):
+        return self._value
+
+
+class FakeAnnotationWrapper:
+    def __init__(self, ann):
+        self._obj = ann
+        self.OMERO_TYPE = type(ann)
+
+    def getId(self):
+        return self._obj.getId().val
+
+    def getTextValue(self):
+        return unwrap(self._obj.getTextValue())
+
+    def getDescription(self):
+        return unwrap(self._obj.getDescription())
+
+    def getNs(self):
+        return unwrap(self._obj.getNs())
+
+    def getMapValueAsMap(self):
+        return {kv.name: kv.value for kv in self._obj.getMapValue()}
+
+
+class FakeObjectWrapper:
+    # Project/Dataset/Image/Roi wrapper for the per-object extraction path
+    def __init__(self, conn, datatype, obj_id):
+        self._conn = conn
+        self._type = datatype
+        self._id = obj_id
+
+    def getId(self):
+        return self._id
+
+    def _row(self):
+        table = {'Project': 'projects', 'Dataset': 'datasets',
+                 'Image': 'images'}[self._type]
+        return self._conn._store[table][self._id]
+
+    def getName(self):
+        return self._row()[0]
+
+    def getDescription(self):
+        return self._row()[1]
+
+    def listAnnotations(self):
+        self._conn._call('gateway.listAnnotations')
+        link_type = f"{self._type}AnnotationLink"
+        anns = self._conn._store['annotations']
+        return [FakeAnnotationWrapper(anns[c]) for p, c
+                in self._conn._store['links'].get(link_type, [])
+                if p == self._id]
+
+    def listChildren(self):
+        self._conn._call('gateway.listChildren')
+        child = {'Project': 'Dataset', 'Dataset': 'Image'}[self._type]
+        link_type = f"{self._type}{child}Link"
+        return [FakeObjectWrapper(self._conn, child, c) for p, c
+                in self._conn._store['links'].get(link_type, [])
+                if p == self._id]
+
+    def getPrimaryPixels(self):
+        return SimpleNamespace(getDimensionOrder=lambda: _Value('XYZCT'),
+                               getPixelsType=lambda: _Value('uint16'),
+                               getSizeC=lambda: 1, getSizeT=lambda: 1,
+                               getSizeX=lambda: 512, getSizeY=lambda: 512,
+                               getSizeZ=lambda: 1)
+
+
+class FakeQueryService:
+    LINKS = re.compile(r"SELECT l\.parent\.id, l\.child\.id FROM (\w+) l")
+    CONTAINERS = re.compile(r"SELECT o\.id, o\.name, o\.description"
+                            r" FROM (Project|Dataset) o")
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def projection(self, query, params, ctx=None):
+        self._conn._call('query.projection')
+        store = self._conn._store
+        ids = set(unwrap(params.map['ids']))
+        match = self.LINKS.search(query)
+        if match:
+            rows = [(p, c) for p, c in store['links'].get(match.group(1), [])
+                    if p in ids]
+        elif self.CONTAINERS.search(query):
+            table = ('projects' if 'FROM Project' in query else 'datasets')
+            rows = [(k, *v) for k, v in store[table].items() if k in ids]
+        elif "FROM Image i JOIN i.pixels p" in query:
+            rows = [(k, v[0], v[1], 'XYZCT', 1, 1, 512, 512, 1, 'uint16')
+                    for k, v in store['images'].items() if k in ids]
+        else:
+            raise NotImplementedError(query)
+        return [[wrap(x) for x in row] for row in rows]
+
+    def findAllByQuery(self, query, params, ctx=None):
+        self._conn._call('query.findAllByQuery')
+        store = self._conn._store
+        ids = set(unwrap(params.map['ids']))
+        if "FROM TagAnnotation a" in query:
+            kind = TagAnnotationI
+        elif "FROM MapAnnotation a" in query:
+            kind = MapAnnotationI
+        elif "FROM Roi r" in query:
+            return [roi for img_id in sorted(ids)
+                    for roi in store['rois'].get(img_id, [])]
+        else:
+            raise NotImplementedError(query)
+        return [a for k, a in store['annotations'].items()
+                if k in ids and isinstance(a, kind)]
+
+
+class FakeUpdateService:
+    def __init__(self, conn):
+        self._conn = conn
+
+    def _save(self, obj):
+        store = self._conn._store
+        with self._conn._lock:
+            obj.setId(rlong(_new_id(store)))
+            name = type(obj).__name__[:-1]
+            if name.endswith('Link'):
+                store['links'].setdefault(name, []).append(
+                    (obj.getParent().getId().val, obj.getChild().getId().val))
+            else:
+                store['saved'].append(obj)
+        return obj
+
+    def saveAndReturnObject(self, obj, ctx=None):
+        self._conn._call('update.saveAndReturnObject')
+        return self._save(obj)
+
+    def saveArray(self, objs, ctx=None):
+        self._conn._call('update.saveArray')
+        for obj in objs:
+            self._save(obj)
+
+    def saveAndReturnArray(self, objs, ctx=None):
+        self._conn._call('update.saveAndReturnArray')
+        return [self._save(obj) for obj in objs]
+
+
+class FakeRoiService:
+    def __init__(self, conn):
+        self._conn = conn
+
+    def findByImage(self, img_id, opts):
+        self._conn._call('roi.findByImage')
+        return SimpleNamespace(rois=self._conn._store['rois'].get(img_id, []))
+
+
+class FakeGateway:
+    def __init__(self, store, latency=0.0):
+        self._store = store
+        self._lock = threading.Lock()
+        self.latency = latency
+        self.calls = {}
+        self.SERVICE_OPTS = ServiceOptsDict()
+
+    def _call(self, name):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def rpc_count(self):
+        return sum(self.calls.values())
+
+    def reset_calls(self):
+        # cleared in place: joined gateways share the dict
+        self.calls.clear()
+
+    def join(self):
+        # stand-in for `omero_pool.join_session`: same store, lock, latency
+        # and call counts
+        worker = FakeGateway(self._store, latency=self.latency)
+        worker._lock = self._lock
+        worker.calls = self.calls
+        return worker
+
+    def getQueryService(self):
+        return FakeQueryService(self)
+
+    def getUpdateService(self):
+        return FakeUpdateService(self)
+
+    def getRoiService(self):
+        return FakeRoiService(self)
+
+    def getObject(self, datatype, obj_id):
+        self._call('gateway.getObject')
+        if datatype == 'Roi':
+            return SimpleNamespace(listAnnotations=lambda: [])
+        return FakeObjectWrapper(self, datatype, int(obj_id))
+
+    def keepAlive(self):
+        self._call('gateway.keepAlive')
+
+    def close(self, hard=True):
+        return
+
+
+def make_pool(conn, size):
+    # what `omero_pool.open_pool` returns, minus the keepalive thread;
+    # shut `pool['executor']` down when done
+    conns = [conn.join() for _ in range(size)]
+    free = queue.Queue()
+    for worker in conns:
+        free.put(worker)
+    return {'main': conn, 'conns': conns, 'free': free,
+            'executor': ThreadPoolExecutor(max_workers=size)}
@@ -0,0 +1,220 @@
+"""
+End-to-end benchmark suite against the fake OMERO gateway.
+
+For each size (number of Images in a synthetic Project) it measures:
+- XML generation, bulk, streamed (bulk) and (with --legacy) per-object,
+  through `populate_xml` on a fake source server;
+- XML parsing, both the full `from_xml` model and the `iter_xml` reader;
+- object creation (Projects, Datasets, annotations) and ROI creation plus
+  linking on a fake destination server;
+- the whole of object creation again, through `populate_omero_stream`
+  on the streamed XML and through `populate_omero` with a pool of
+  `--pool-size` destination sessions;
+and the number of OMERO calls each step made. `--latency` adds a fixed
+delay to every call, to see how steps behave against a remote server.
+`--json` saves the results, and `--baseline` compares them with results
+saved by an earlier run: any step that got slower, or makes more OMERO
+calls, by more than `--threshold` is reported and the script exits with
+a non-zero status, so regressions show up before a release.
+
+Run from the repository root with
+    python -m benchmarks.offline [--sizes 100 1000 ...] [--latency 0.002]
+                                 [--json new.json] [--baseline old.json]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from ome_types import from_xml
+from generate_xml import populate_xml
+from generate_omero_objects import create_containers, populate_images
+from generate_omero_objects import iter_xml, populate_omero
+from generate_omero_objects import populate_omero_stream
+from benchmarks.fake_omero import FakeGateway, create_store, make_project
+from benchmarks.fake_omero import add_images, make_pool
+
+
+def timed(conn, func, *args, **kwargs):
+    # (seconds, OMERO calls) for one step
+    if conn is not None:
+        conn.reset_calls()
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    return elapsed, conn.rpc_count() if conn is not None else 0
+
+
+def populate_fresh(populate, fp, ome, args, pool_size=1, **kwargs):
+    # (seconds, OMERO calls) for a whole `populate_omero*` run on a new
+    # destination, through a pool if `pool_size` > 1
+    dest = FakeGateway(create_store(), latency=args.latency)
+    dest_ids = add_images(dest._store, len(ome.images))
+    img_map = {img.id: i for img, i in zip(ome.images, dest_ids)}
+    pool = make_pool(dest, pool_size) if pool_size > 1 else None
+    try:
+        return timed(dest, populate, fp, img_map, dest, pool=pool,
+                     **kwargs)
+    finally:
+        if pool is not None:
+            pool['executor'].shutdown()
+
+
+def run_size(n_images, args, tmp_dir):
+    n_datasets = max(1, n_images // args.images_per_dataset)
+    store, proj_id = make_project(n_datasets=n_datasets,
+                                  images_per_dataset=args.images_per_dataset,
+                                  n_tags=args.tags, n_maps=args.maps,
+                                  rois_per_image=args.rois_per_image,
+                                  shapes_per_roi=args.shapes_per_roi)
+    source = FakeGateway(store, latency=args.latency)
+    fp = os.path.join(tmp_dir, f"bench_{n_images}.xml")
+    results = {}
+    results['xml_bulk'] = timed(source, populate_xml, 'Project', proj_id, fp,
+                                source, bulk=True)
+    stream_fp = os.path.join(tmp_dir, f"bench_{n_images}_stream.xml")
+    results['xml_stream'] = timed(source, populate_xml, 'Project', proj_id,
+                                  stream_fp, source, bulk=True, stream=True)
+    if args.legacy:
+        legacy_fp = os.path.join(tmp_dir, f"bench_{n_images}_legacy.xml")
+        results['xml_legacy'] = timed(source, populate_xml, 'Project',
+                                      proj_id, legacy_fp, source)
+    results['parse_from_xml'] = timed(None, from_xml, fp)
+    results['parse_iter_xml'] = timed(None, lambda: sum(
+        1 for _ in iter_xml(fp, validate=False)))
+
+    ome = from_xml(fp)
+    dest = FakeGateway(create_store(), latency=args.latency)
+    dest_ids = add_images(dest._store, len(ome.images))
+    img_map = {img.id: i for img, i in zip(ome.images, dest_ids)}
+    maps = {}
+
+    def containers():
+        maps['all'] = create_containers(ome, dest)
+
+    results['create_containers'] = timed(dest, containers)
+    _, ds_map, ann_map = maps['all']
+    results['rois_and_links'] = timed(dest, populate_images, ome, ome.images,
+                                      ome.datasets, ds_map, img_map, ann_map,
+                                      dest)
+    results['populate_stream'] = populate_fresh(populate_omero_stream,
+                                                stream_fp, ome, args,
+                                                validate=False)
+    results['populate_pool'] = populate_fresh(populate_omero, fp, ome, args,
+                                              pool_size=args.pool_size)
+    shapes = sum(len(roi.union) for roi in ome.rois)
+    return {'images': n_images, 'datasets': n_datasets, 'shapes': shapes,
+            'steps': {k: {'seconds': s, 'rpcs': n}
+                      for k, (s, n) in results.items()}}
+
+
+def compare(results, baseline, threshold, min_seconds):
+    """
+    Steps of `results` that regressed against `baseline` (both as saved
+    by `--json`), matched by number of images and step name. A step
+    regresses when its time or RPC count grows by more than `threshold`
+    (a fraction); steps under `min_seconds` in both runs are too noisy
+    to compare times for.
+    """
+    old = {(r['images'], step): v for r in baseline['results']
+           for step, v in r['steps'].items()}
+    regressions = []
+    for r in results:
+        for step, new in r['steps'].items():
+            prev = old.get((r['images'], step))
+            if prev is None:
+                continue
+            for key in ['seconds', 'rpcs']:
+                if (key == 'seconds' and
+                        max(new[key], prev[key]) < min_seconds):
+                    continue
+                if new[key] > prev[key] * (1 + threshold):
+                    regressions.append((r['images'], step, key, prev[key],
+                                        new[key]))
+    return regressions
+
+
+def run(args):
+    print(f"{'images':>8} {'shapes':>8} {'step':<18} {'seconds':>9}"
+          f" {'rpcs':>7}")
+    all_results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n in args.sizes:
+            res = run_size(n, args, tmp_dir)
+            all_results.append(res)
+            for step, r in res['steps'].items():
+                print(f"{n:>8} {res['shapes']:>8} {step:<18}"
+                      f" {r['seconds']:>9.3f} {r['rpcs']:>7}")
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump({'latency': args.latency, 'results': all_results}, fp,
+                      indent=2)
+        print(f"Results saved at {args.json}.")
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        if baseline.get('latency') != args.latency:
+            print(f"Warning: baseline was run with latency "
+                  f"{baseline.get('latency')}, this run with {args.latency}.")
+        regressions = compare(all_results, baseline, args.threshold,
+                              args.min_seconds)
+        for n, step, key, prev, new in regressions:
+            print(f"REGRESSION {n} images, {step}: {key} {prev:.3f} -> "
+                  f"{new:.3f}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes',
+                        type=int,
+                        nargs='+',
+                        default=[10, 100, 1000],
+                        help='numbers of images in the synthetic Project')
+    parser.add_argument('--images-per-dataset',
+                        type=int,
+                        default=100)
+    parser.add_argument('--tags',
+                        type=int,
+                        default=20)
+    parser.add_argument('--maps',
+                        type=int,
+                        default=50)
+    parser.add_argument('--rois-per-image',
+                        type=int,
+                        default=10)
+    parser.add_argument('--shapes-per-roi',
+                        type=int,
+                        default=1)
+    parser.add_argument('--latency',
+                        type=float,
+                        default=0.0,
+                        help='seconds added to every OMERO call')
+    parser.add_argument('--pool-size',
+                        type=int,
+                        default=4,
+                        help='destination sessions for the pooled step')
+    parser.add_argument('--legacy',
+                        action='store_true',
+                        help='also time the per-object XML generation')
+    parser.add_argument('--json',
+                        type=str,
+                        help='save the results to this file')
+    parser.add_argument('--baseline',
+                        type=str,
+                        help='results of an earlier run (from --json) to'
+                             ' compare with')
+    parser.add_argument('--threshold',
+                        type=float,
+                        default=0.2,
+                        help='relative increase in time or OMERO calls'
+                             ' counted as a regression')
+    parser.add_argument('--min-seconds',
+                        type=float,
+                        default=0.05,
+                        help='ignore time changes of steps shorter than'
+                             ' this')
+    run(parser.parse_args())
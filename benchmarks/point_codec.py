@@ -0,0 +1,74 @@
+"""
+Micro-benchmark for parsing and formatting polygon/polyline points.
+
+Compares the per-point Python loop `create_shapes` used to run against
+the NumPy codec in `point_codec`, both one string at a time and for a
+whole batch of strings at once (as `create_shapes` now does per ROI).
+
+Run from the repository root with
+    python -m benchmarks.point_codec [--vertices 10 100 1000] [--shapes N]
+"""
+import argparse
+import random
+import time
+from point_codec import parse_points, format_points
+from point_codec import parse_points_bulk, format_points_bulk
+
+
+def loop_codec(points):
+    # the original split/rstrip loop
+    pts = []
+    for pt in points.split(" "):
+        pt = pt.rstrip(",")
+        pts.append(tuple(float(x) for x in pt.split(",")))
+    return " ".join(f"{x},{y}" for x, y in pts)
+
+
+def numpy_codec(points):
+    return format_points(parse_points(points))
+
+
+def numpy_bulk_codec(points_list):
+    return format_points_bulk(*parse_points_bulk(points_list))
+
+
+def make_points(n_vertices, trailing_comma=True):
+    sep = ", " if trailing_comma else " "
+    return sep.join(f"{random.uniform(0, 4096):.2f},"
+                    f"{random.uniform(0, 4096):.2f}"
+                    for _ in range(n_vertices))
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def run(vertices, n_shapes):
+    print(f"{'vertices':>10} {'loop s':>10} {'numpy s':>10}"
+          f" {'bulk s':>10} {'speedup':>10}")
+    for n in vertices:
+        strings = [make_points(n) for _ in range(n_shapes)]
+        loop = timed(lambda: [loop_codec(s) for s in strings])
+        single = timed(lambda: [numpy_codec(s) for s in strings])
+        bulk = timed(numpy_bulk_codec, strings)
+        assert numpy_bulk_codec(strings[:5]) == [loop_codec(s)
+                                                 for s in strings[:5]]
+        print(f"{n:>10} {loop:>10.3f} {single:>10.3f} {bulk:>10.3f}"
+              f" {loop / bulk:>9.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vertices',
+                        type=int,
+                        nargs='+',
+                        default=[4, 10, 100, 1000],
+                        help='numbers of vertices per polygon')
+    parser.add_argument('--shapes',
+                        type=int,
+                        default=10000,
+                        help='number of polygons per run')
+    args = parser.parse_args()
+    run(args.vertices, args.shapes)
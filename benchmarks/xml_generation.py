@@ -0,0 +1,129 @@
+"""
+Scaling benchmark for building the transfer OME model.
+
+Builds synthetic images with ROIs, tags and map annotations through the
+same helpers `generate_xml` uses and reports the time per shape at each
+size. With the ID registry the time per shape should stay flat as the
+number of shapes grows. With --populate, the same number of shapes is
+also extracted from a synthetic Project on the fake gateway through
+`populate_xml` (bulk queries), XML file included.
+
+Run from the repository root with
+    python -m benchmarks.xml_generation [--sizes 1000 10000 ...]
+"""
+import argparse
+import math
+import os
+import tempfile
+import time
+from ome_types import OME
+from ome_types.model import Map, Polygon, Pixels
+from ome_types.model.map import M
+from generate_xml import create_image_and_ref, create_roi_and_ref
+from generate_xml import create_tag_and_ref, create_kv_and_ref
+from generate_xml import create_registry, register, populate_xml
+from benchmarks.fake_omero import FakeGateway, make_project
+
+SHAPES_PER_ROI = 1
+ROIS_PER_IMAGE = 100
+N_TAGS = 50
+IMAGES_PER_DATASET = 100
+
+
+def build_model(n_shapes, use_registry=True):
+    ome = OME()
+    reg = create_registry()
+
+    def add(obj, ome_list, index):
+        if use_registry:
+            register(obj, ome_list, index)
+        elif obj not in ome_list:
+            ome_list.append(obj)
+
+    shape_id = 0
+    roi_id = 0
+    img_id = 0
+    while shape_id < n_shapes:
+        img_id += 1
+        pixels = Pixels(id=img_id, dimension_order='XYZCT', size_c=1,
+                        size_t=1, size_x=512, size_y=512, size_z=1,
+                        type='uint16', metadata_only=True)
+        img, _ = create_image_and_ref(id=img_id, name=f"img{img_id}",
+                                      pixels=pixels)
+        # every image shares one of a few tags and has its own map
+        tag, ref = create_tag_and_ref(id=img_id % N_TAGS + 1,
+                                      value=f"tag{img_id % N_TAGS}")
+        add(tag, ome.structured_annotations, reg['annotations'])
+        img.annotation_ref.append(ref)
+        kv, ref = create_kv_and_ref(id=N_TAGS + img_id,
+                                    value=Map(m=[M(k='image',
+                                                   value=str(img_id))]))
+        add(kv, ome.structured_annotations, reg['annotations'])
+        img.annotation_ref.append(ref)
+        for _ in range(ROIS_PER_IMAGE):
+            if shape_id >= n_shapes:
+                break
+            roi_id += 1
+            shapes = []
+            for _ in range(SHAPES_PER_ROI):
+                shape_id += 1
+                shapes.append(Polygon(id=shape_id,
+                                      points="0,0 10,0 10,10 0,10"))
+            roi, roi_ref = create_roi_and_ref(id=roi_id, union=shapes)
+            add(roi, ome.rois, reg['rois'])
+            img.roi_ref.append(roi_ref)
+        add(img, ome.images, reg['images'])
+    return ome
+
+
+def populate(n_shapes, tmp_dir, stream=False):
+    # `populate_xml` on a synthetic Project with about `n_shapes` shapes
+    n_images = math.ceil(n_shapes / (ROIS_PER_IMAGE * SHAPES_PER_ROI))
+    store, proj_id = make_project(
+        n_datasets=math.ceil(n_images / IMAGES_PER_DATASET),
+        images_per_dataset=min(n_images, IMAGES_PER_DATASET),
+        n_tags=N_TAGS, n_maps=N_TAGS, rois_per_image=ROIS_PER_IMAGE,
+        shapes_per_roi=SHAPES_PER_ROI, n_vertices=4)
+    fp = os.path.join(tmp_dir, f"populate_{n_shapes}.xml")
+    start = time.perf_counter()
+    populate_xml('Project', proj_id, fp, FakeGateway(store), bulk=True,
+                 stream=stream)
+    return time.perf_counter() - start
+
+
+def run(sizes, use_registry, with_populate=False, stream=False):
+    header = f"{'shapes':>10} {'seconds':>10} {'us/shape':>10}"
+    if with_populate:
+        header += f" {'populate':>10} {'us/shape':>10}"
+    print(header)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n in sizes:
+            start = time.perf_counter()
+            build_model(n, use_registry=use_registry)
+            elapsed = time.perf_counter() - start
+            line = f"{n:>10} {elapsed:>10.2f} {elapsed / n * 1e6:>10.1f}"
+            if with_populate:
+                elapsed = populate(n, tmp_dir, stream)
+                line += f" {elapsed:>10.2f} {elapsed / n * 1e6:>10.1f}"
+            print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes',
+                        type=int,
+                        nargs='+',
+                        default=[1000, 10000, 100000, 1000000],
+                        help='numbers of shapes to generate')
+    parser.add_argument('--list-scan',
+                        action='store_true',
+                        help='use the old `not in` list checks instead of'
+                             ' the registry (keep sizes small!)')
+    parser.add_argument('--populate',
+                        action='store_true',
+                        help='also time populate_xml on the fake gateway')
+    parser.add_argument('--stream',
+                        action='store_true',
+                        help='with --populate, use the streaming export')
+    args = parser.parse_args()
+    run(args.sizes, not args.list_scan, args.populate, args.stream)
@@ -1,201 +1,712 @@
 import ezomero
 import argparse
-from omero.model import DatasetI
+from itertools import chain
+from xml.etree import ElementTree
+from omero.model import DatasetI, ProjectI, ImageI
+from omero.model import TagAnnotationI, MapAnnotationI
+from omero.model import ProjectAnnotationLinkI, DatasetAnnotationLinkI
+from omero.model import ImageAnnotationLinkI
+from omero.model import ProjectDatasetLinkI, DatasetImageLinkI
+from omero.model import RoiI, PointI, LineI, RectangleI, EllipseI, PolygonI
+from omero.model import LengthI
+from omero.model.enums import UnitsLength
+from omero.rtypes import rdouble, rint, rstring, unwrap
+from omero.sys import Parameters
+from transfer_journal import load_objects, record_objects
+from transfer_journal import is_done, mark_done
+from generate_xml import bulk_projection
+from point_codec import parse_points_bulk, format_points_bulk
+from omero_pool import pool_map
+from transfer_metrics import rpc, debug
 from omero.gateway import DatasetWrapper
 from ome_types import from_xml
-from ome_types.model import TagAnnotation, MapAnnotation
+from ome_types.model import Project, Dataset, DatasetRef
+from ome_types.model import Image, ImageRef, Pixels, ROI, ROIRef
+from ome_types.model import TagAnnotation, MapAnnotation, AnnotationRef, Map
 from ome_types.model import Line, Point, Rectangle, Ellipse, Polygon, Polyline
+from ome_types.model.map import M
 from omero.gateway import TagAnnotationWrapper, MapAnnotationWrapper
-from ezomero import rois
 
+# maximum number of objects sent in a single `saveArray` call
+SAVE_CHUNK_SIZE = 1000
+# default maximum number of shapes sent in a single ROI `saveAndReturnArray`
+ROI_BATCH_SIZE = 5000
+# namespace of tag sets, which `load_tag_cache` leaves out
+TAGSET_NS = "openmicroscopy.org/omero/insight/tagset"
+# top-level XML elements read by `iter_xml`, and their `OME` lists
+SECTIONS = {'Project': 'projects', 'Dataset': 'datasets',
+            'Image': 'images', 'ROI': 'rois'}
+SHAPE_CLASSES = {'Point': Point, 'Line': Line, 'Rectangle': Rectangle,
+                 'Ellipse': Ellipse, 'Polygon': Polygon, 'Polyline': Polyline}
+SHAPE_ATTRS = {'ID': 'id', 'X': 'x', 'Y': 'y', 'X1': 'x1', 'Y1': 'y1',
+               'X2': 'x2', 'Y2': 'y2', 'Width': 'width', 'Height': 'height',
+               'RadiusX': 'radius_x', 'RadiusY': 'radius_y',
+               'Points': 'points', 'Text': 'text', 'TheZ': 'the_z',
+               'TheT': 'the_t', 'TheC': 'the_c', 'Locked': 'locked',
+               'FillColor': 'fill_color', 'StrokeColor': 'stroke_color'}
+PIXELS_ATTRS = {'ID': 'id', 'DimensionOrder': 'dimension_order',
+                'Type': 'type', 'SizeX': 'size_x', 'SizeY': 'size_y',
+                'SizeZ': 'size_z', 'SizeC': 'size_c', 'SizeT': 'size_t'}
 
-def create_projects(pjs, conn):
-    pj_map = {}
-    for pj in pjs:
-        pj_id = ezomero.post_project(conn, pj.name, pj.description)
+
+def _local(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _child_text(el, tag):
+    for child in el:
+        if _local(child.tag) == tag:
+            return child.text
+    return None
+
+
+def _child_refs(el, tag):
+    return [child.get('ID') for child in el if _local(child.tag) == tag]
+
+
+def _attrs(el, names):
+    # XML attribute -> model field, for the attributes that are present
+    return {field: el.get(attr) for attr, field in names.items()
+            if el.get(attr) is not None}
+
+
+def _decode_shape(el):
+    shape_class = SHAPE_CLASSES.get(_local(el.tag))
+    if shape_class is None:
+        return None
+    args = _attrs(el, SHAPE_ATTRS)
+    for color in ('fill_color', 'stroke_color'):
+        if color in args:
+            args[color] = int(args[color])
+    return shape_class(**args)
+
+
+def decode_element(el):
+    # builds the ome-types model for one top-level element of a
+    # transfer XML (see `generate_xml`) without schema validation
+    tag = _local(el.tag)
+    common = {'id': el.get('ID'),
+              'description': _child_text(el, 'Description'),
+              'annotation_ref': [AnnotationRef(id=i) for i in
+                                 _child_refs(el, 'AnnotationRef')]}
+    if tag == 'Project':
+        return Project(name=el.get('Name'),
+                       dataset_ref=[DatasetRef(id=i) for i in
+                                    _child_refs(el, 'DatasetRef')],
+                       **common)
+    if tag == 'Dataset':
+        return Dataset(name=el.get('Name'),
+                       image_ref=[ImageRef(id=i) for i in
+                                  _child_refs(el, 'ImageRef')],
+                       **common)
+    if tag == 'Image':
+        pixels = None
+        for child in el:
+            if _local(child.tag) == 'Pixels':
+                pixels = Pixels(metadata_only=True,
+                                **_attrs(child, PIXELS_ATTRS))
+        return Image(name=el.get('Name'), pixels=pixels,
+                     roi_ref=[ROIRef(id=i) for i in
+                              _child_refs(el, 'ROIRef')],
+                     **common)
+    if tag == 'TagAnnotation':
+        return TagAnnotation(namespace=el.get('Namespace'),
+                             value=_child_text(el, 'Value'), **common)
+    if tag == 'MapAnnotation':
+        mmap = []
+        for child in el:
+            if _local(child.tag) == 'Value':
+                mmap = [M(k=m.get('K'), value=m.text or '') for m in child]
+        return MapAnnotation(namespace=el.get('Namespace'),
+                             value=Map(m=mmap), **common)
+    if tag == 'ROI':
+        shapes = []
+        for child in el:
+            if _local(child.tag) == 'Union':
+                shapes = [s for s in map(_decode_shape, child)
+                          if s is not None]
+        return ROI(name=el.get('Name'), union=shapes, **common)
+    return None
+
+
+def validate_xml(fp):
+    # schema validation reading the document lazily, so it is not
+    # loaded into memory whole
+    import xmlschema
+    from ome_types.schema import get_schema
+    resource = xmlschema.XMLResource(fp, lazy=True)
+    get_schema(resource).validate(resource)
+
+
+def iter_xml(fp, validate=True, sections=None):
+    """
+    Yields (section, model) for every Project, Dataset, Image, annotation
+    and ROI in a transfer XML, in document order, where section is the
+    name of the matching `OME` list ('projects', 'structured_annotations'
+    ...). Elements are freed once yielded, so memory use stays flat.
+    `validate=False` skips schema validation, for XMLs we generated.
+    If `sections` is given, only those sections are decoded and yielded.
+    """
+    if validate:
+        validate_xml(fp)
+    stack = []
+    for event, el in ElementTree.iterparse(fp, events=('start', 'end')):
+        if event == 'start':
+            stack.append(el)
+            continue
+        stack.pop()
+        tag = _local(el.tag)
+        if len(stack) == 1 and tag in SECTIONS:
+            if sections is None or SECTIONS[tag] in sections:
+                yield SECTIONS[tag], decode_element(el)
+            stack[0].clear()
+        elif (len(stack) == 2 and
+              _local(stack[1].tag) == 'StructuredAnnotations'):
+            if sections is None or 'structured_annotations' in sections:
+                ann = decode_element(el)
+                if ann is not None:
+                    yield 'structured_annotations', ann
+            stack[1].clear()
+
+
+def _post_project(pj, conn):
+    with rpc('ezomero.post_project'):
+        return ezomero.post_project(conn, pj.name, pj.description)
+
+
+def create_projects(pjs, conn, journal=None, pool=None):
+    pj_map = load_objects(journal, 'Project')
+    todo = [pj for pj in pjs if pj.id not in pj_map]
+    for pj, pj_id in zip(todo, pool_map(_post_project, todo, conn, pool)):
         pj_map[pj.id] = pj_id
+        record_objects(journal, 'Project', {pj.id: pj_id})
     return pj_map
 
 
-def create_datasets(dss, conn):
+def _post_dataset(ds, conn):
     """
     Currently doing it the non-ezomero way because ezomero always 
     puts "orphan" Datasets in the user's default group
     """
-    ds_map = {}
-    for ds in dss:
-        dataset = DatasetWrapper(conn, DatasetI())
-        dataset.setName(ds.name)
-        if ds.description is not None:
-            dataset.setDescription(ds.description)
+    dataset = DatasetWrapper(conn, DatasetI())
+    dataset.setName(ds.name)
+    if ds.description is not None:
+        dataset.setDescription(ds.description)
+    with rpc('gateway.save'):
         dataset.save()
-        ds_id = dataset.getId()
+    return dataset.getId()
+
+
+def create_datasets(dss, conn, journal=None, pool=None):
+    ds_map = load_objects(journal, 'Dataset')
+    todo = [ds for ds in dss if ds.id not in ds_map]
+    for ds, ds_id in zip(todo, pool_map(_post_dataset, todo, conn, pool)):
         ds_map[ds.id] = ds_id
+        record_objects(journal, 'Dataset', {ds.id: ds_id})
     return ds_map
 
 
-def create_annotations(ans, conn):
-    ann_map = {}
-    for an in ans:
-        if isinstance(an, TagAnnotation):
-            tag_ann = TagAnnotationWrapper(conn)
-            tag_ann.setValue(an.value)
-            tag_ann.setDescription(an.description)
+def _post_annotation(an, conn):
+    # returns the new annotation's ID, or None for unsupported types
+    if isinstance(an, TagAnnotation):
+        tag_ann = TagAnnotationWrapper(conn)
+        tag_ann.setValue(an.value)
+        tag_ann.setDescription(an.description)
+        if an.namespace:
+            tag_ann.setNs(an.namespace)
+        with rpc('gateway.save'):
             tag_ann.save()
-            ann_map[an.id] = tag_ann.getId()
-        elif isinstance(an, MapAnnotation):
-            map_ann = MapAnnotationWrapper(conn)
-            namespace = an.namespace
-            map_ann.setNs(namespace)
-            key_value_data = []
-            for v in an.value.m:
-                key_value_data.append([v.k, v.value])
-            map_ann.setValue(key_value_data)
+        return tag_ann.getId()
+    elif isinstance(an, MapAnnotation):
+        map_ann = MapAnnotationWrapper(conn)
+        namespace = an.namespace
+        map_ann.setNs(namespace)
+        key_value_data = []
+        for v in an.value.m:
+            key_value_data.append([v.k, v.value])
+        map_ann.setValue(key_value_data)
+        with rpc('gateway.save'):
             map_ann.save()
-            ann_map[an.id] = map_ann.getId()
+        return map_ann.getId()
+    return None
+
+
+def tag_key(value, description, ns=None):
+    # what makes two tags "the same" for `tag_cache` purposes
+    return (value or '', description or '', ns or '')
+
+
+def load_tag_cache(conn):
+    # (value, description, namespace) -> ID of the tags already on the
+    # destination (in the current group, tag sets excluded), with a
+    # single query. When several tags match, the oldest one is used
+    with rpc('query.projection'):
+        rows = conn.getQueryService().projection(
+            "SELECT a.id, a.textValue, a.description, a.ns"
+            " FROM TagAnnotation a ORDER BY a.id", Parameters(),
+            conn.SERVICE_OPTS)
+    tag_cache = {}
+    for row in rows:
+        tag_id, value, desc, ns = [unwrap(c) for c in row]
+        if ns == TAGSET_NS:
+            continue
+        tag_cache.setdefault(tag_key(value, desc, ns), tag_id)
+    return tag_cache
+
+
+def _match_tags(ans, ann_map, tag_cache, journal):
+    # maps tags found in `tag_cache`; returns the annotations still to
+    # create (only the first of several identical new tags) and the
+    # identical ones to map once that first tag exists
+    todo, later, new_keys, matched = [], [], set(), {}
+    for an in ans:
+        if isinstance(an, TagAnnotation):
+            key = tag_key(an.value, an.description, an.namespace)
+            if key in tag_cache:
+                matched[an.id] = tag_cache[key]
+                continue
+            if key in new_keys:
+                later.append(an)
+                continue
+            new_keys.add(key)
+        todo.append(an)
+    ann_map.update(matched)
+    record_objects(journal, 'Annotation', matched)
+    return todo, later
+
+
+def create_annotations(ans, conn, journal=None, ann_map=None, pool=None,
+                       tag_cache=None):
+    # `ann_map` lets callers feeding annotations in groups keep
+    # extending the same map. With a `tag_cache` (see `load_tag_cache`)
+    # tags matching an existing destination tag are linked to it instead
+    # of being created, and new tags are added to the cache
+    if ann_map is None:
+        ann_map = load_objects(journal, 'Annotation')
+    todo = [an for an in ans if an.id not in ann_map]
+    later = []
+    if tag_cache is not None:
+        todo, later = _match_tags(todo, ann_map, tag_cache, journal)
+    for an, ann_id in zip(todo, pool_map(_post_annotation, todo, conn,
+                                         pool)):
+        if ann_id is None:
+            continue
+        ann_map[an.id] = ann_id
+        record_objects(journal, 'Annotation', {an.id: ann_id})
+        if tag_cache is not None and isinstance(an, TagAnnotation):
+            key = tag_key(an.value, an.description, an.namespace)
+            tag_cache[key] = ann_id
+    if later:
+        _match_tags(later, ann_map, tag_cache, journal)
     return ann_map
 
 
-def create_shapes(roi):
+def _set_shape_attributes(sh, shape, fill_color, stroke_color):
+    sh.setTheZ(rint(shape.the_z))
+    sh.setTheC(rint(shape.the_c))
+    sh.setTheT(rint(shape.the_t))
+    if shape.text is not None:
+        sh.setTextValue(rstring(shape.text))
+    if fill_color is not None:
+        sh.setFillColor(rint(fill_color))
+    if stroke_color is not None:
+        sh.setStrokeColor(rint(stroke_color))
+        sh.setStrokeWidth(LengthI(1, UnitsLength.PIXEL))
+    return sh
+
+
+def create_shapes(roi, fill_color=None, stroke_color=None):
     shapes = []
+    # all polygon/polyline points of the ROI are normalized in one go
+    polys = [s.points for s in roi.union
+             if isinstance(s, Polygon) or isinstance(s, Polyline)]
+    points = iter(format_points_bulk(*parse_points_bulk(polys))
+                  if polys else [])
     for shape in roi.union:
         if isinstance(shape, Point):
-            sh = rois.Point(shape.x, shape.y, z=shape.the_z, c=shape.the_c,
-                            t=shape.the_t, label=shape.text)
+            sh = PointI()
+            sh.setX(rdouble(shape.x))
+            sh.setY(rdouble(shape.y))
         elif isinstance(shape, Line):
-            sh = rois.Line(shape.x1, shape.y1, shape.x2, shape.y2,
-                           z=shape.the_z, c=shape.the_c, t=shape.the_t,
-                           label=shape.text)
+            sh = LineI()
+            sh.setX1(rdouble(shape.x1))
+            sh.setY1(rdouble(shape.y1))
+            sh.setX2(rdouble(shape.x2))
+            sh.setY2(rdouble(shape.y2))
         elif isinstance(shape, Rectangle):
-            sh = rois.Rectangle(shape.x, shape.y, shape.width, shape.height,
-                                z=shape.the_z, c=shape.the_c, t=shape.the_t,
-                                label=shape.text)
+            sh = RectangleI()
+            sh.setX(rdouble(shape.x))
+            sh.setY(rdouble(shape.y))
+            sh.setWidth(rdouble(shape.width))
+            sh.setHeight(rdouble(shape.height))
         elif isinstance(shape, Ellipse):
-            sh = rois.Ellipse(shape.x, shape.y, shape.radius_x, shape.radius_y,
-                              z=shape.the_z, c=shape.the_c, t=shape.the_t,
-                              label=shape.text)
+            sh = EllipseI()
+            sh.setX(rdouble(shape.x))
+            sh.setY(rdouble(shape.y))
+            sh.setRadiusX(rdouble(shape.radius_x))
+            sh.setRadiusY(rdouble(shape.radius_y))
         elif isinstance(shape, Polygon) or isinstance(shape, Polyline):
-            points = []
-            for pt in shape.points.split(" "):
-                # points sometimes come with a comma at the end...
-                pt = pt.rstrip(",")
-                points.append(tuple(float(x) for x in pt.split(",")))
-            sh = rois.Polygon(points, z=shape.the_z, c=shape.the_c,
-                              t=shape.the_t, label=shape.text)
+            sh = PolygonI()
+            sh.setPoints(rstring(next(points)))
         else:
             continue
-        shapes.append(sh)
+        shapes.append(_set_shape_attributes(sh, shape, fill_color,
+                                            stroke_color))
     return shapes
 
 
-def _int_to_rgba(omero_val):
-    """ Helper function returning the color as an Integer in RGBA encoding """
-    if omero_val < 0:
-        omero_val = omero_val + (2**32)
-    r = omero_val >> 24
-    g = omero_val - (r << 24) >> 16
-    b = omero_val - (r << 24) - (g << 16) >> 8
-    a = omero_val - (r << 24) - (g << 16) - (b << 8)
-    a = a / 256.0
-    return (r, g, b, a)
+def _color_to_int(color):
+    """ Helper function returning a color as a signed RGBA Integer """
+    if color is None:
+        return None
+    omero_val = int(color)
+    if omero_val > (2**31 - 1):
+        omero_val = omero_val - (2**32)
+    return omero_val
 
 
-def create_rois(rois, imgs, img_map, conn):
+def create_roi(roi, img_id_dest):
+    # builds an (unsaved) RoiI with all its shapes attached
+    roi_obj = RoiI()
+    roi_obj.setImage(ImageI(img_id_dest, False))
+    if roi.name is not None:
+        roi_obj.setName(rstring(roi.name))
+    if roi.description:
+        roi_obj.setDescription(rstring(roi.description))
+    fill_color = stroke_color = None
+    if roi.union:
+        # using colors for the first shape
+        fill_color = _color_to_int(roi.union[0].fill_color)
+        stroke_color = _color_to_int(roi.union[0].stroke_color)
+    for sh in create_shapes(roi, fill_color, stroke_color):
+        roi_obj.addShape(sh)
+    return roi_obj
+
+
+def shared_rois(imgs):
+    # IDs of ROIs referenced by more than one image, which only happens
+    # in XMLs generated with content dedup
+    seen, shared = set(), set()
     for img in imgs:
-        for roiref in img.roi_ref:
-            roi = next(filter(lambda x: x.id == roiref.id, rois))
-            shapes = create_shapes(roi)
-            img_id_dest = img_map[img.id]
-            # using colors for the first shape
-            fill_color = _int_to_rgba(int(roi.union[0].fill_color))
-            stroke_color = _int_to_rgba(int(roi.union[0].stroke_color))
-            ezomero.post_roi(conn, img_id_dest, shapes, name=roi.name,
-                             description=roi.description,
-                             fill_color=fill_color, stroke_color=stroke_color)
+        for ref in img.roi_ref:
+            if ref.id in seen:
+                shared.add(ref.id)
+            seen.add(ref.id)
+    return shared
+
+
+def per_image_rois(imgs, dedup=False):
+    # whether ROIs are journaled per destination image (see `roi_key`):
+    # always for XMLs made with content dedup, so that keys don't change
+    # between syncs as ROIs start or stop being shared, and for any XML
+    # with a ROI referenced by more than one image
+    return dedup or bool(shared_rois(imgs))
+
+
+def roi_key(roi_id, img_id_dest, per_image):
+    # journal key of a ROI: its source ID, plus the destination image
+    # when ROIs can be shared between images, since OMERO needs one copy
+    # per image
+    if per_image:
+        return f"{roi_id}@{img_id_dest}"
+    return roi_id
+
+
+def create_rois(rois, imgs, img_map, conn, batch_size=ROI_BATCH_SIZE,
+                journal=None, pool=None, per_image=False):
+    roi_index = {roi.id: roi for roi in rois}
+    pairs = ((roi_index[roiref.id], img_map[img.id])
+             for img in imgs if img.id in img_map
+             for roiref in img.roi_ref)
+    return save_rois(pairs, conn, batch_size=batch_size, journal=journal,
+                     pool=pool, per_image=per_image)
+
+
+def _save_roi_batch(batch, conn):
+    # (source IDs, RoiI objects) -> source -> dest ROI ID map
+    batch_ids, roi_objs = batch
+    with rpc('update.saveAndReturnArray'):
+        saved = conn.getUpdateService().saveAndReturnArray(
+            roi_objs, conn.SERVICE_OPTS)
+    saved_map = {}
+    for src_id, roi_obj in zip(batch_ids, saved):
+        saved_map[src_id] = roi_obj.getId().getValue()
+    return saved_map
+
+
+def _roi_batches(pairs, roi_map, batch_size, per_image):
+    batch_ids, batch, batch_shapes = [], [], 0
+    for roi, img_id_dest in pairs:
+        key = roi_key(roi.id, img_id_dest, per_image)
+        if key in roi_map:
+            continue
+        n_shapes = len(roi.union)
+        if batch and batch_shapes + n_shapes > batch_size:
+            yield batch_ids, batch
+            batch_ids, batch, batch_shapes = [], [], 0
+        batch.append(create_roi(roi, img_id_dest))
+        batch_ids.append(key)
+        batch_shapes += n_shapes
+    if batch:
+        yield batch_ids, batch
+
+
+def save_rois(pairs, conn, batch_size=ROI_BATCH_SIZE, journal=None,
+              pool=None, per_image=False):
+    # takes (ROI, destination image ID) pairs, which can come from a
+    # generator, and sends them in batches of at most `batch_size`
+    # shapes (a single larger ROI goes on its own), spread across the
+    # pool's sessions if there is one.
+    # returns a source -> dest ROI ID map
+    roi_map = load_objects(journal, 'ROI')
+    batches = _roi_batches(pairs, roi_map, batch_size, per_image)
+    for saved_map in pool_map(_save_roi_batch, batches, conn, pool):
+        roi_map.update(saved_map)
+        record_objects(journal, 'ROI', saved_map)
+    return roi_map
+
+
+def _save_chunk(chunk, conn):
+    with rpc('update.saveArray'):
+        conn.getUpdateService().saveArray(chunk, conn.SERVICE_OPTS)
+
+
+def save_in_chunks(objs, conn, chunk_size=SAVE_CHUNK_SIZE, pool=None):
+    # saves new objects with one `saveArray` call per chunk
+    chunks = (objs[i:i + chunk_size] for i in range(0, len(objs), chunk_size))
+    for _ in pool_map(_save_chunk, chunks, conn, pool):
+        pass
     return
 
 
-def link_datasets(ome, proj_map, ds_map, conn):
-    for proj in ome.projects:
+def create_link(link_class, parent, child):
+    link = link_class()
+    link.setParent(parent)
+    link.setChild(child)
+    return link
+
+
+def save_new_links(links, conn, pool=None):
+    # saves only the links that don't already exist destination-side,
+    # so linking the same objects again (resumed or repeated transfers)
+    # does not create duplicates
+    by_type = {}
+    for link in links:
+        by_type.setdefault(type(link).__name__[:-1], []).append(link)
+    new_links = []
+    for link_type, typed_links in by_type.items():
+        parent_ids = set(lk.getParent().getId().val for lk in typed_links)
+        existing = set(tuple(r) for r in bulk_projection(
+            f"SELECT l.parent.id, l.child.id FROM {link_type} l"
+            " WHERE l.parent.id IN (:ids)", sorted(parent_ids), conn))
+        for link in typed_links:
+            pair = (link.getParent().getId().val, link.getChild().getId().val)
+            if pair not in existing:
+                existing.add(pair)
+                new_links.append(link)
+    save_in_chunks(new_links, conn, pool=pool)
+    return
+
+
+def link_datasets(projects, proj_map, ds_map, conn, pool=None):
+    links = []
+    for proj in projects:
         proj_id = proj_map[proj.id]
-        ds_ids = []
         for ds in proj.dataset_ref:
-            ds_id = ds_map[ds.id]
-            ds_ids.append(ds_id)
-        ezomero.link_datasets_to_project(conn, ds_ids, proj_id)
+            links.append(create_link(ProjectDatasetLinkI,
+                                     ProjectI(proj_id, False),
+                                     DatasetI(ds_map[ds.id], False)))
+    save_new_links(links, conn, pool)
     return
 
 
-def link_images(ome, ds_map, img_map, conn):
-    for ds in ome.datasets:
+def link_images(dss, ds_map, img_map, conn, pool=None):
+    # images that were not imported are left out
+    links = []
+    for ds in dss:
         ds_id = ds_map[ds.id]
-        img_ids = []
         for img in ds.image_ref:
-            img_id = img_map[img.id]
-            img_ids.append(img_id)
-        ezomero.link_images_to_dataset(conn, img_ids, ds_id)
+            if img.id in img_map:
+                links.append(create_link(DatasetImageLinkI,
+                                         DatasetI(ds_id, False),
+                                         ImageI(img_map[img.id], False)))
+    save_new_links(links, conn, pool)
     return
 
 
-def link_annotations(ome, proj_map, ds_map, img_map, ann_map, conn):
-    for proj in ome.projects:
-        proj_id = proj_map[proj.id]
-        proj_obj = conn.getObject("Project", proj_id)
-        anns = ome.structured_annotations
-        for annref in proj.annotation_ref:
-            ann = next(filter(lambda x: x.id == annref.id, anns))
-            ann_id = ann_map[ann.id]
-            if isinstance(ann, TagAnnotation):
-                ann_obj = conn.getObject("TagAnnotation", ann_id)
-            elif isinstance(ann, MapAnnotation):
-                ann_obj = conn.getObject("MapAnnotation", ann_id)
-            else:
-                continue
-            proj_obj.linkAnnotation(ann_obj)
-    for ds in ome.datasets:
-        ds_id = ds_map[ds.id]
-        ds_obj = conn.getObject("Dataset", ds_id)
-        anns = ome.structured_annotations
-        for annref in ds.annotation_ref:
-            ann = next(filter(lambda x: x.id == annref.id, anns))
-            ann_id = ann_map[ann.id]
-            if isinstance(ann, TagAnnotation):
-                ann_obj = conn.getObject("TagAnnotation", ann_id)
-            elif isinstance(ann, MapAnnotation):
-                ann_obj = conn.getObject("MapAnnotation", ann_id)
-            else:
-                continue
-            ds_obj.linkAnnotation(ann_obj)
-    for img in ome.images:
-        img_id = img_map[img.id]
-        img_obj = conn.getObject("Image", img_id)
-        anns = ome.structured_annotations
-        for annref in img.annotation_ref:
-            ann = next(filter(lambda x: x.id == annref.id, anns))
-            ann_id = ann_map[ann.id]
-            if isinstance(ann, TagAnnotation):
-                ann_obj = conn.getObject("TagAnnotation", ann_id)
-            elif isinstance(ann, MapAnnotation):
-                ann_obj = conn.getObject("MapAnnotation", ann_id)
-            else:
-                continue
-            img_obj.linkAnnotation(ann_obj)
+def annotation_types(anns):
+    # source annotation ID -> model class, all that linking needs
+    return {ann.id: type(ann) for ann in anns}
+
+
+def create_annotation_links(link_class, parent_class, parent_id, annrefs,
+                            ann_types, ann_map):
+    # builds (unsaved) annotation links to an existing destination object
+    links = []
+    for annref in annrefs:
+        ann_type = ann_types.get(annref.id)
+        if ann_type is None or annref.id not in ann_map:
+            continue
+        if issubclass(ann_type, TagAnnotation):
+            child = TagAnnotationI(ann_map[annref.id], False)
+        elif issubclass(ann_type, MapAnnotation):
+            child = MapAnnotationI(ann_map[annref.id], False)
+        else:
+            continue
+        links.append(create_link(link_class, parent_class(parent_id, False),
+                                 child))
+    return links
+
+
+def link_container_annotations(projects, datasets, proj_map, ds_map,
+                               ann_map, ann_types, conn, pool=None):
+    links = []
+    for proj in projects:
+        links.extend(create_annotation_links(ProjectAnnotationLinkI, ProjectI,
+                                             proj_map[proj.id],
+                                             proj.annotation_ref,
+                                             ann_types, ann_map))
+    for ds in datasets:
+        links.extend(create_annotation_links(DatasetAnnotationLinkI, DatasetI,
+                                             ds_map[ds.id],
+                                             ds.annotation_ref,
+                                             ann_types, ann_map))
+    save_new_links(links, conn, pool)
+    return
+
+
+def link_image_annotations(imgs, img_map, ann_map, ann_types, conn,
+                           pool=None):
+    links = []
+    for img in imgs:
+        if img.id not in img_map:
+            continue
+        links.extend(create_annotation_links(ImageAnnotationLinkI, ImageI,
+                                             img_map[img.id],
+                                             img.annotation_ref,
+                                             ann_types, ann_map))
+    save_new_links(links, conn, pool)
+    return
+
+
+def create_containers(ome, conn, journal=None, pool=None, tag_cache=None):
+    # everything that does not depend on imported images: Projects,
+    # Datasets, Annotations and the links between them
+    proj_map = create_projects(ome.projects, conn, journal, pool)
+    debug(proj_map)
+    ds_map = create_datasets(ome.datasets, conn, journal, pool)
+    debug(ds_map)
+    ann_map = create_annotations(ome.structured_annotations, conn, journal,
+                                 pool=pool, tag_cache=tag_cache)
+    debug(ann_map)
+    if not is_done(journal, 'link_datasets'):
+        link_datasets(ome.projects, proj_map, ds_map, conn, pool)
+        mark_done(journal, 'link_datasets')
+    if not is_done(journal, 'link_container_annotations'):
+        link_container_annotations(
+            ome.projects, ome.datasets, proj_map, ds_map, ann_map,
+            annotation_types(ome.structured_annotations), conn, pool)
+        mark_done(journal, 'link_container_annotations')
+    return proj_map, ds_map, ann_map
+
+
+def populate_images(ome, imgs, dss, ds_map, img_map, ann_map, conn,
+                    roi_batch_size=ROI_BATCH_SIZE, journal=None,
+                    pool=None, per_image=None):
+    # ROIs and annotation links for imported images `imgs`, plus the
+    # links between datasets `dss` and their images. Links are not
+    # marked done in the journal: images missing now (failed imports)
+    # may be imported by a resumed run, and `save_new_links` skips the
+    # links that already exist. `per_image` is `per_image_rois` of all
+    # images in `ome`; callers going through images in groups should
+    # work it out once and pass it in
+    if per_image is None:
+        per_image = per_image_rois(ome.images)
+    create_rois(ome.rois, imgs, img_map, conn, batch_size=roi_batch_size,
+                journal=journal, pool=pool, per_image=per_image)
+    link_images(dss, ds_map, img_map, conn, pool)
+    link_image_annotations(imgs, img_map, ann_map,
+                           annotation_types(ome.structured_annotations), conn,
+                           pool)
     return
 
 
-def populate_omero(fp, img_map, conn):
+def populate_omero(fp, img_map, conn, roi_batch_size=ROI_BATCH_SIZE,
+                   journal=None, pool=None, tag_cache=None, dedup=False):
+    # with a journal, objects and links already created by a previous
+    # (interrupted) run are reused instead of being created again.
+    # `dedup` is whether the XML was generated with content dedup.
+    # `conn` is left open: closing it is up to the caller
     ome = from_xml(fp)
-    proj_map = create_projects(ome.projects, conn)
-    print(proj_map)
-    ds_map = create_datasets(ome.datasets, conn)
-    print(ds_map)
-    ann_map = create_annotations(ome.structured_annotations, conn)
-    print(ann_map)
-    create_rois(ome.rois, ome.images, img_map, conn)
-    link_datasets(ome, proj_map, ds_map, conn)
-    link_images(ome, ds_map, img_map, conn)
-    link_annotations(ome, proj_map, ds_map, img_map, ann_map, conn)
-    conn.close()
+    _, ds_map, ann_map = create_containers(ome, conn, journal, pool,
+                                           tag_cache)
+    populate_images(ome, ome.images, ome.datasets, ds_map, img_map, ann_map,
+                    conn, roi_batch_size=roi_batch_size, journal=journal,
+                    pool=pool, per_image=per_image_rois(ome.images, dedup))
+    return
+
+
+def populate_omero_stream(fp, img_map, conn, roi_batch_size=ROI_BATCH_SIZE,
+                          journal=None, validate=True, pool=None,
+                          tag_cache=None, dedup=False):
+    # same as `populate_omero`, but reading the XML one element at a
+    # time: annotations are created and ROIs sent as they are read, and
+    # only Projects, Datasets and Images (without ROIs) are kept
+    items = iter_xml(fp, validate=validate)
+    projects, datasets, images = [], [], []
+    ann_types = {}
+    ann_map = load_objects(journal, 'Annotation')
+    ann_batch = []
+    first_roi = None
+    for section, obj in items:
+        if section == 'projects':
+            projects.append(obj)
+        elif section == 'datasets':
+            datasets.append(obj)
+        elif section == 'images':
+            images.append(obj)
+        elif section == 'structured_annotations':
+            ann_types[obj.id] = type(obj)
+            ann_batch.append(obj)
+            if len(ann_batch) >= SAVE_CHUNK_SIZE:
+                create_annotations(ann_batch, conn, journal, ann_map, pool,
+                                   tag_cache)
+                ann_batch = []
+        elif section == 'rois':
+            # ROIs are last in the document; they're handled below
+            first_roi = obj
+            break
+    create_annotations(ann_batch, conn, journal, ann_map, pool, tag_cache)
+    roi_imgs = {}
+    for img in images:
+        for ref in img.roi_ref:
+            roi_imgs.setdefault(ref.id, []).append(img.id)
+    per_image = dedup or any(len(v) > 1 for v in roi_imgs.values())
+
+    def roi_pairs():
+        if first_roi is None:
+            return
+        for section, roi in chain([('rois', first_roi)], items):
+            if section != 'rois':
+                continue
+            for img_id in roi_imgs.get(roi.id, []):
+                if img_id in img_map:
+                    yield roi, img_map[img_id]
+
+    save_rois(roi_pairs(), conn, batch_size=roi_batch_size, journal=journal,
+              pool=pool, per_image=per_image)
+    proj_map = create_projects(projects, conn, journal, pool)
+    ds_map = create_datasets(datasets, conn, journal, pool)
+    if not is_done(journal, 'link_datasets'):
+        link_datasets(projects, proj_map, ds_map, conn, pool)
+        mark_done(journal, 'link_datasets')
+    if not is_done(journal, 'link_container_annotations'):
+        link_container_annotations(projects, datasets, proj_map, ds_map,
+                                   ann_map, ann_types, conn, pool)
+        mark_done(journal, 'link_container_annotations')
+    # not marked done, see `populate_images`
+    link_images(datasets, ds_map, img_map, conn, pool)
+    link_image_annotations(images, img_map, ann_map, ann_types, conn, pool)
     return
 
 
@@ -209,3 +720,4 @@ if __name__ == "__main__":
     args = parser.parse_args()
     image_map = {"Image:51": 1405, "Image:52": 1406, "Image:27423": 1404}
     populate_omero(args.filepath, image_map, conn)
+    conn.close()
@@ -8,8 +8,36 @@ from ome_types.model import Point, Line, Rectangle, Ellipse, Polygon
 from ome_types.model.map import M
 from omero.model import TagAnnotationI, MapAnnotationI
 from omero.model import PointI, LineI, RectangleI, EllipseI, PolygonI
+from omero.sys import Parameters
+from omero.rtypes import rlist, rlong, unwrap
 import ezomero
 import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree
+from point_codec import parse_points, format_points
+from omero_pool import join_session
+from transfer_metrics import rpc
+
+# maximum number of IDs sent in a single `IN (:ids)` query
+QUERY_CHUNK_SIZE = 1000
+# number of objects serialized at once by the streaming XML writer
+STREAM_BATCH_SIZE = 1000
+# number of Images per task when extracting a Dataset in parallel, and
+# number of Images whose data is fetched at once when streaming one
+EXTRACT_CHUNK_SIZE = 100
+# top-level OME sections, in the order the schema requires them
+STREAM_SECTIONS = ['projects', 'datasets', 'images',
+                   'structured_annotations', 'rois']
+OME_NS = "http://www.openmicroscopy.org/Schemas/OME/2016-06"
+XSI_NS = "http://www.w3.org/2001/XMLSchema-instance"
+ElementTree.register_namespace('', OME_NS)
 
 
 def create_proj_and_ref(**kwargs):
@@ -64,6 +92,79 @@ def create_roi_and_ref(**kwargs):
     return roi, roiref
 
 
+def create_registry(dedup=False):
+    # OME IDs of everything already added to the OME model, so duplicate
+    # checks are a set lookup instead of a list scan comparing whole
+    # models. Only IDs are kept, so objects already written out by a
+    # streaming export can be dropped from memory. With `dedup`, content
+    # hashes are kept too (see `register_content`)
+    reg = {'annotations': set(), 'rois': set(), 'images': set(),
+           'datasets': set()}
+    if dedup:
+        reg['hashes'] = {}
+        reg['aliases'] = {}
+    return reg
+
+
+def register(obj, ome_list, index):
+    # appends `obj` to the OME list unless its ID is already there;
+    # returns whether it was added
+    if obj.id in index:
+        return False
+    index.add(obj.id)
+    ome_list.append(obj)
+    return True
+
+
+def register_content(obj, ome_list, reg, kind):
+    """
+    Registers `obj` like `register` and returns the ID refs to it should
+    use. In content-dedup mode, a MapAnnotation or ROI identical to one
+    already registered (same namespace and key/value list; same shapes
+    and annotations) is not added: the ID of the first one is returned,
+    and remembered as an alias of `obj`'s own ID.
+    """
+    aliases = reg.get('aliases')
+    if aliases is not None and isinstance(obj, (MapAnnotation, ROI)):
+        if obj.id in aliases:
+            return aliases[obj.id]
+        key = content_hash(obj)
+        if isinstance(obj, ROI):
+            key += ":" + ",".join(sorted(r.id for r in obj.annotation_ref))
+        first = reg['hashes'].setdefault(key, obj.id)
+        if first != obj.id:
+            aliases[obj.id] = first
+            return first
+    register(obj, ome_list, reg[kind])
+    return obj.id
+
+
+def dedup_stats(reg):
+    # how many MapAnnotations/ROIs content dedup folded into others
+    stats = {'MapAnnotation': 0, 'ROI': 0}
+    for alias in reg.get('aliases', {}):
+        stats['ROI' if alias.startswith('ROI:') else 'MapAnnotation'] += 1
+    return stats
+
+
+def content_hash(obj):
+    # hash of what an annotation or ROI holds, ignoring IDs and refs,
+    # so the same content always hashes the same way
+    if isinstance(obj, TagAnnotation):
+        payload = ['Tag', obj.value, obj.description]
+    elif isinstance(obj, MapAnnotation):
+        payload = ['Map', obj.namespace, [[m.k, m.value] for m in obj.value.m]]
+    elif isinstance(obj, ROI):
+        payload = ['ROI', obj.name, obj.description,
+                   [[type(s).__name__,
+                     s.dict(exclude={'id', 'annotation_ref'})]
+                    for s in obj.union]]
+    else:
+        return None
+    dump = json.dumps(payload, sort_keys=True, default=str)
+    return hashlib.sha1(dump.encode()).hexdigest()
+
+
 def create_point(shape):
     args = {'id': shape.getId().val, 'x': shape.getX().val,
             'y': shape.getY().val}
@@ -168,7 +269,9 @@ def create_ellipse(shape):
 
 
 def create_polygon(shape):
-    args = {'id': shape.getId().val, 'points': shape.getPoints().val}
+    # normalized here so the XML never carries trailing commas
+    points = format_points(parse_points(shape.getPoints().val))
+    args = {'id': shape.getId().val, 'points': points}
     args['text'] = ''
     args['the_c'] = 0
     args['the_z'] = 0
@@ -214,7 +317,19 @@ def create_shapes(roi):
     return shapes
 
 
-def populate_roi(obj, roi_obj, ome, conn):
+def list_annotations(obj):
+    # listAnnotations/listChildren are generators: the server call
+    # happens while they are consumed, so that is what gets timed
+    with rpc('gateway.listAnnotations'):
+        return list(obj.listAnnotations())
+
+
+def list_children(obj):
+    with rpc('gateway.listChildren'):
+        return list(obj.listChildren())
+
+
+def populate_roi(obj, roi_obj, ome, conn, reg):
     id = obj.getId().getValue()
     name = obj.getName()
     if name is not None:
@@ -225,12 +340,13 @@ def populate_roi(obj, roi_obj, ome, conn):
     shapes = create_shapes(obj)
     roi, roi_ref = create_roi_and_ref(id=id, name=name, description=desc,
                                       union=shapes)
-    for ann in roi_obj.listAnnotations():
+    for ann in list_annotations(roi_obj):
         if ann.OMERO_TYPE == TagAnnotationI:
             tag, ref = create_tag_and_ref(id=ann.getId(),
-                                          value=ann.getTextValue())
-            if tag not in ome.structured_annotations:
-                ome.structured_annotations.append(tag)
+                                          value=ann.getTextValue(),
+                                          description=ann.getDescription(),
+                                          namespace=ann.getNs())
+            register(tag, ome.structured_annotations, reg['annotations'])
             roi.annotation_ref.append(ref)
         if ann.OMERO_TYPE == MapAnnotationI:
             mmap = [M(k=_key, value=str(_value))
@@ -243,27 +359,27 @@ def populate_roi(obj, roi_obj, ome, conn):
                                         namespace=ann.getNs(),
                                         value=Map(
                                         m=mmap))
-            if kv not in ome.structured_annotations:
-                ome.structured_annotations.append(kv)
+            ref.id = register_content(kv, ome.structured_annotations, reg,
+                                      'annotations')
             roi.annotation_ref.append(ref)
-    if roi not in ome.rois:
-        ome.rois.append(roi)
+    roi_ref.id = register_content(roi, ome.rois, reg, 'rois')
     return roi_ref
 
 
-def populate_image(obj, ome, conn):
+def populate_image(obj, ome, conn, reg):
     id = obj.getId()
     name = obj.getName()
     desc = obj.getDescription()
     pix = create_pixels(obj)
     img, img_ref = create_image_and_ref(id=id, name=name,
                                         description=desc, pixels=pix)
-    for ann in obj.listAnnotations():
+    for ann in list_annotations(obj):
         if ann.OMERO_TYPE == TagAnnotationI:
             tag, ref = create_tag_and_ref(id=ann.getId(),
-                                          value=ann.getTextValue())
-            if tag not in ome.structured_annotations:
-                ome.structured_annotations.append(tag)
+                                          value=ann.getTextValue(),
+                                          description=ann.getDescription(),
+                                          namespace=ann.getNs())
+            register(tag, ome.structured_annotations, reg['annotations'])
             img.annotation_ref.append(ref)
         if ann.OMERO_TYPE == MapAnnotationI:
             mmap = [M(k=_key, value=str(_value))
@@ -276,32 +392,34 @@ def populate_image(obj, ome, conn):
                                         namespace=ann.getNs(),
                                         value=Map(
                                         m=mmap))
-            if kv not in ome.structured_annotations:
-                ome.structured_annotations.append(kv)
+            ref.id = register_content(kv, ome.structured_annotations, reg,
+                                      'annotations')
             img.annotation_ref.append(ref)
     roi_service = conn.getRoiService()
-    rois = roi_service.findByImage(id, None).rois
+    with rpc('roi.findByImage'):
+        rois = roi_service.findByImage(id, None).rois
     for roi in rois:
-        roi_obj = conn.getObject('Roi', roi.getId().getValue())
-        roi_ref = populate_roi(roi, roi_obj, ome, conn)
+        with rpc('gateway.getObject'):
+            roi_obj = conn.getObject('Roi', roi.getId().getValue())
+        roi_ref = populate_roi(roi, roi_obj, ome, conn, reg)
         img.roi_ref.append(roi_ref)
-    if img not in ome.images:
-        ome.images.append(img)
+    register(img, ome.images, reg['images'])
     return img_ref
 
 
-def populate_dataset(obj, ome, conn):
+def populate_dataset(obj, ome, conn, reg, stream=None, workers=1):
     id = obj.getId()
     name = obj.getName()
     desc = obj.getDescription()
     ds, ds_ref = create_dataset_and_ref(id=id, name=name,
                                         description=desc)
-    for ann in obj.listAnnotations():
+    for ann in list_annotations(obj):
         if ann.OMERO_TYPE == TagAnnotationI:
             tag, ref = create_tag_and_ref(id=ann.getId(),
-                                          value=ann.getTextValue())
-            if tag not in ome.structured_annotations:
-                ome.structured_annotations.append(tag)
+                                          value=ann.getTextValue(),
+                                          description=ann.getDescription(),
+                                          namespace=ann.getNs())
+            register(tag, ome.structured_annotations, reg['annotations'])
             ds.annotation_ref.append(ref)
         if ann.OMERO_TYPE == MapAnnotationI:
             mmap = [M(k=_key, value=str(_value))
@@ -314,29 +432,37 @@ def populate_dataset(obj, ome, conn):
                                         namespace=ann.getNs(),
                                         value=Map(
                                         m=mmap))
-            if kv not in ome.structured_annotations:
-                ome.structured_annotations.append(kv)
+            ref.id = register_content(kv, ome.structured_annotations, reg,
+                                      'annotations')
             ds.annotation_ref.append(ref)
-    for img in obj.listChildren():
-        img_obj = conn.getObject('Image', img.getId())
-        img_ref = populate_image(img_obj, ome, conn)
-        ds.image_ref.append(img_ref)
-    if ds not in ome.datasets:
-        ome.datasets.append(ds)
+    if workers > 1:
+        img_ids = [img.getId() for img in list_children(obj)]
+        ds.image_ref.extend(
+            extract_parallel('Image', img_ids, ome, conn, reg, workers,
+                             stream=stream))
+    else:
+        for img in list_children(obj):
+            with rpc('gateway.getObject'):
+                img_obj = conn.getObject('Image', img.getId())
+            img_ref = populate_image(img_obj, ome, conn, reg)
+            ds.image_ref.append(img_ref)
+            flush_stream(stream, ome)
+    register(ds, ome.datasets, reg['datasets'])
     return ds_ref
 
 
-def populate_project(obj, ome, conn):
+def populate_project(obj, ome, conn, reg, stream=None, workers=1):
     id = obj.getId()
     name = obj.getName()
     desc = obj.getDescription()
     test_proj, _ = create_proj_and_ref(id=id, name=name, description=desc)
-    for ann in obj.listAnnotations():
+    for ann in list_annotations(obj):
         if ann.OMERO_TYPE == TagAnnotationI:
             tag, ref = create_tag_and_ref(id=ann.getId(),
-                                          value=ann.getTextValue())
-            if tag not in ome.structured_annotations:
-                ome.structured_annotations.append(tag)
+                                          value=ann.getTextValue(),
+                                          description=ann.getDescription(),
+                                          namespace=ann.getNs())
+            register(tag, ome.structured_annotations, reg['annotations'])
             test_proj.annotation_ref.append(ref)
         if ann.OMERO_TYPE == MapAnnotationI:
             mmap = [M(k=_key, value=str(_value))
@@ -349,29 +475,509 @@ def populate_project(obj, ome, conn):
                                         namespace=ann.getNs(),
                                         value=Map(
                                         m=mmap))
-            if kv not in ome.structured_annotations:
-                ome.structured_annotations.append(kv)
+            ref.id = register_content(kv, ome.structured_annotations, reg,
+                                      'annotations')
             test_proj.annotation_ref.append(ref)
-    for ds in obj.listChildren():
-        ds_obj = conn.getObject('Dataset', ds.getId())
-        ds_ref = populate_dataset(ds_obj, ome, conn)
-        test_proj.dataset_ref.append(ds_ref)
+    if workers > 1 and stream is None:
+        ds_ids = [ds.getId() for ds in list_children(obj)]
+        test_proj.dataset_ref.extend(
+            extract_parallel('Dataset', ds_ids, ome, conn, reg, workers))
+    else:
+        # when streaming, workers share the Images of one Dataset at a
+        # time rather than each holding a whole Dataset
+        for ds in list_children(obj):
+            with rpc('gateway.getObject'):
+                ds_obj = conn.getObject('Dataset', ds.getId())
+            ds_ref = populate_dataset(ds_obj, ome, conn, reg, stream,
+                                      workers)
+            test_proj.dataset_ref.append(ds_ref)
     ome.projects.append(test_proj)
 
 
-def populate_xml(datatype, id, filepath, conn):
-    ome = OME()
-    obj = conn.getObject(datatype, id)
+def _chunks(ids, size=QUERY_CHUNK_SIZE):
+    ids = list(ids)
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+
+def _id_params(chunk):
+    params = Parameters()
+    params.map = {"ids": rlist([rlong(i) for i in chunk])}
+    return params
+
+
+def bulk_projection(query, ids, conn):
+    # runs a projection with an `IN (:ids)` clause, chunked by ID,
+    # returning rows of unwrapped values
+    q = conn.getQueryService()
+    rows = []
+    for chunk in _chunks(ids):
+        with rpc('query.projection'):
+            results = q.projection(query, _id_params(chunk),
+                                   conn.SERVICE_OPTS)
+        rows.extend([[unwrap(c) for c in r] for r in results])
+    return rows
+
+
+def bulk_find(query, ids, conn):
+    # same as `bulk_projection`, but returning loaded model objects
+    q = conn.getQueryService()
+    objs = []
+    for chunk in _chunks(ids):
+        with rpc('query.findAllByQuery'):
+            objs.extend(q.findAllByQuery(query, _id_params(chunk),
+                                         conn.SERVICE_OPTS))
+    return objs
+
+
+def fetch_children(link_type, parent_ids, conn):
+    # parent ID -> ordered list of child IDs for a hierarchy link type
+    children = {}
+    rows = bulk_projection(f"SELECT l.parent.id, l.child.id FROM {link_type} l"
+                           " WHERE l.parent.id IN (:ids)"
+                           " ORDER BY l.id", parent_ids, conn)
+    for parent_id, child_id in rows:
+        children.setdefault(parent_id, []).append(child_id)
+    return children
+
+
+def fetch_containers(datatype, ids, conn):
+    # ID -> (name, description) for Projects or Datasets
+    rows = bulk_projection(f"SELECT o.id, o.name, o.description"
+                           f" FROM {datatype} o WHERE o.id IN (:ids)",
+                           ids, conn)
+    return {r[0]: (r[1], r[2]) for r in rows}
+
+
+def fetch_images(ids, conn):
+    # ID -> (name, description, Pixels) for Images
+    rows = bulk_projection("SELECT i.id, i.name, i.description,"
+                           " p.dimensionOrder.value, p.sizeC, p.sizeT,"
+                           " p.sizeX, p.sizeY, p.sizeZ, p.pixelsType.value"
+                           " FROM Image i JOIN i.pixels p"
+                           " WHERE i.id IN (:ids)"
+                           " ORDER BY p.id", ids, conn)
+    images = {}
+    for r in rows:
+        # we're assuming a single Pixels object per image
+        if r[0] in images:
+            continue
+        pixels = Pixels(id=r[0], dimension_order=r[3], size_c=r[4],
+                        size_t=r[5], size_x=r[6], size_y=r[7], size_z=r[8],
+                        type=r[9], metadata_only=True)
+        images[r[0]] = (r[1], r[2], pixels)
+    return images
+
+
+def fetch_annotations(link_type, parent_ids, conn):
+    # parent ID -> ordered list of Tag/MapAnnotation model objects
+    links = bulk_projection("SELECT l.parent.id, l.child.id"
+                            f" FROM {link_type} l"
+                            " WHERE l.parent.id IN (:ids)"
+                            " ORDER BY l.id", parent_ids, conn)
+    ann_ids = sorted(set(r[1] for r in links))
+    anns = {}
+    for ann in bulk_find("SELECT a FROM TagAnnotation a"
+                         " WHERE a.id IN (:ids)", ann_ids, conn):
+        anns[ann.getId().val] = ann
+    for ann in bulk_find("SELECT DISTINCT a FROM MapAnnotation a"
+                         " LEFT OUTER JOIN FETCH a.mapValue"
+                         " WHERE a.id IN (:ids)", ann_ids, conn):
+        anns[ann.getId().val] = ann
+    parent_anns = {}
+    for parent_id, ann_id in links:
+        if ann_id in anns:
+            parent_anns.setdefault(parent_id, []).append(anns[ann_id])
+    return parent_anns
+
+
+def fetch_rois(img_ids, conn):
+    # Image ID -> list of ROIs with their shapes loaded
+    rois = {}
+    for roi in bulk_find("SELECT DISTINCT r FROM Roi r"
+                         " LEFT OUTER JOIN FETCH r.shapes"
+                         " WHERE r.image.id IN (:ids)"
+                         " ORDER BY r.id", img_ids, conn):
+        img_id = roi.getImage().getId().val
+        rois.setdefault(img_id, []).append(roi)
+    return rois
+
+
+def create_annotation_and_ref(ann):
+    # builds an OME annotation from a TagAnnotationI/MapAnnotationI
+    ann_id = ann.getId().val
+    if isinstance(ann, TagAnnotationI):
+        return create_tag_and_ref(id=ann_id,
+                                  value=unwrap(ann.getTextValue()),
+                                  description=unwrap(ann.getDescription()),
+                                  namespace=unwrap(ann.getNs()))
+    if isinstance(ann, MapAnnotationI):
+        # same behaviour as MapAnnotationWrapper.getMapValueAsMap()
+        kvs = {kv.name: kv.value for kv in ann.getMapValue()}
+        mmap = [M(k=_key, value=str(_value))
+                for _key, _value in kvs.items()]
+        for m in mmap:
+            if m.value == '':
+                m.value = ' '
+        return create_kv_and_ref(id=ann_id, namespace=unwrap(ann.getNs()),
+                                 value=Map(m=mmap))
+    return None, None
+
+
+def fetch_subtree(datatype, id, conn, shallow=False):
+    # pulls everything needed to describe a Project/Dataset/Image
+    # with a handful of batched queries. A `shallow` fetch stops at
+    # the container itself and its child links (Datasets of a Project,
+    # Images of a Dataset)
+    id = int(id)
+    data = {'proj_ids': [], 'ds_ids': [], 'proj_ds': {}, 'ds_imgs': {}}
+    if datatype == 'Project':
+        data['proj_ids'] = [id]
+        data['proj_ds'] = fetch_children('ProjectDatasetLink', [id], conn)
+        if not shallow:
+            data['ds_ids'] = data['proj_ds'].get(id, [])
+    if datatype == 'Dataset':
+        data['ds_ids'] = [id]
+    if datatype == 'Image':
+        img_ids = [id]
+    else:
+        data['ds_imgs'] = fetch_children('DatasetImageLink', data['ds_ids'],
+                                         conn)
+        img_ids = sorted(set(i for v in data['ds_imgs'].values()
+                             for i in v))
+        if shallow:
+            img_ids = []
+    data['projects'] = fetch_containers('Project', data['proj_ids'], conn)
+    data['proj_anns'] = fetch_annotations('ProjectAnnotationLink',
+                                          data['proj_ids'], conn)
+    data['datasets'] = fetch_containers('Dataset', data['ds_ids'], conn)
+    data['ds_anns'] = fetch_annotations('DatasetAnnotationLink',
+                                        data['ds_ids'], conn)
+    data.update(fetch_image_data(img_ids, conn))
+    return data
+
+
+def fetch_image_data(img_ids, conn):
+    # the Image part of `fetch_subtree`, for a list of Image IDs
+    data = {}
+    data['images'] = fetch_images(img_ids, conn)
+    data['img_anns'] = fetch_annotations('ImageAnnotationLink', img_ids,
+                                         conn)
+    data['rois'] = fetch_rois(img_ids, conn)
+    roi_ids = [r.getId().val for v in data['rois'].values() for r in v]
+    data['roi_anns'] = fetch_annotations('RoiAnnotationLink', roi_ids, conn)
+    return data
+
+
+def add_annotations_bulk(target, anns, ome, reg):
+    aliases = reg.get('aliases', {})
+    for ann in anns:
+        ann_key = f"Annotation:{ann.getId().val}"
+        ann_key = aliases.get(ann_key, ann_key)
+        if ann_key not in reg['annotations']:
+            kv, _ = create_annotation_and_ref(ann)
+            if kv is None:
+                continue
+            ann_key = register_content(kv, ome.structured_annotations, reg,
+                                       'annotations')
+        target.annotation_ref.append(AnnotationRef(id=ann_key))
+
+
+def populate_roi_bulk(obj, ome, data, reg):
+    id = obj.getId().getValue()
+    shapes = create_shapes(obj)
+    roi, roi_ref = create_roi_and_ref(id=id, name=unwrap(obj.getName()),
+                                      description=unwrap(obj.getDescription()),
+                                      union=shapes)
+    add_annotations_bulk(roi, data['roi_anns'].get(id, []), ome, reg)
+    roi_ref.id = register_content(roi, ome.rois, reg, 'rois')
+    return roi_ref
+
+
+def populate_image_bulk(id, ome, data, reg):
+    if f"Image:{id}" in reg['images']:
+        return ImageRef(id=id)
+    name, desc, pix = data['images'][id]
+    img, img_ref = create_image_and_ref(id=id, name=name,
+                                        description=desc, pixels=pix)
+    add_annotations_bulk(img, data['img_anns'].get(id, []), ome, reg)
+    for roi in data['rois'].get(id, []):
+        img.roi_ref.append(populate_roi_bulk(roi, ome, data, reg))
+    register(img, ome.images, reg['images'])
+    return img_ref
+
+
+def populate_dataset_bulk(id, ome, data, reg, stream=None, conn=None,
+                          workers=1):
+    name, desc = data['datasets'][id]
+    ds, ds_ref = create_dataset_and_ref(id=id, name=name,
+                                        description=desc)
+    add_annotations_bulk(ds, data['ds_anns'].get(id, []), ome, reg)
+    if workers > 1:
+        ds.image_ref.extend(
+            extract_parallel('Image', data['ds_imgs'].get(id, []), ome,
+                             conn, reg, workers, bulk=True, stream=stream))
+    else:
+        img_ids = data['ds_imgs'].get(id, [])
+        chunks = [img_ids]
+        if stream is not None:
+            # `data` stops at the Dataset: Images, annotations, ROIs and
+            # shapes are fetched for a chunk of Images at a time
+            chunks = _chunks(img_ids, EXTRACT_CHUNK_SIZE)
+        for chunk in chunks:
+            img_data = data
+            if stream is not None:
+                img_data = fetch_image_data(
+                    [i for i in chunk if f"Image:{i}" not in reg['images']],
+                    conn)
+            for img_id in chunk:
+                ds.image_ref.append(populate_image_bulk(img_id, ome,
+                                                        img_data, reg))
+                flush_stream(stream, ome)
+    register(ds, ome.datasets, reg['datasets'])
+    return ds_ref
+
+
+def populate_project_bulk(id, ome, data, reg, conn=None, stream=None,
+                          workers=1):
+    name, desc = data['projects'][id]
+    proj, _ = create_proj_and_ref(id=id, name=name, description=desc)
+    add_annotations_bulk(proj, data['proj_anns'].get(id, []), ome, reg)
+    if workers > 1 and stream is None:
+        proj.dataset_ref.extend(
+            extract_parallel('Dataset', data['proj_ds'].get(id, []), ome,
+                             conn, reg, workers, bulk=True))
+        ome.projects.append(proj)
+        return
+    for ds_id in data['proj_ds'].get(id, []):
+        ds_data = data
+        if stream is not None:
+            # only one Dataset's metadata in memory at a time (and only
+            # a chunk of its Images, see `populate_dataset_bulk`); with
+            # workers, they share the Images of the Dataset
+            ds_data = fetch_subtree('Dataset', ds_id, conn, shallow=True)
+        proj.dataset_ref.append(populate_dataset_bulk(ds_id, ome, ds_data,
+                                                      reg, stream, conn,
+                                                      workers))
+    ome.projects.append(proj)
+
+
+def populate_bulk(datatype, id, ome, conn, reg, stream=None, workers=1):
+    # workers (and streamed exports, a chunk of Images at a time) fetch
+    # their own part of the subtree, so only the top level is fetched here
+    shallow = workers > 1 or stream is not None
+    data = fetch_subtree(datatype, id, conn, shallow=shallow)
     if datatype == 'Project':
-        populate_project(obj, ome, conn)
+        populate_project_bulk(int(id), ome, data, reg, conn, stream, workers)
+    if datatype == 'Dataset':
+        populate_dataset_bulk(int(id), ome, data, reg, stream, conn, workers)
+    if datatype == 'Image':
+        populate_image_bulk(int(id), ome, data, reg)
+
+
+def extract_fragment(datatype, ids, conn, bulk=False, dedup=False):
+    # builds a standalone OME fragment for some Datasets or Images,
+    # returning it with their refs in the order of `ids` and the content
+    # dedup aliases made inside it
+    frag = OME()
+    reg = create_registry(dedup)
+    refs = []
     if datatype == 'Dataset':
-        populate_dataset(obj, ome, conn)
+        for ds_id in ids:
+            if bulk:
+                data = fetch_subtree('Dataset', ds_id, conn)
+                refs.append(populate_dataset_bulk(ds_id, frag, data, reg))
+            else:
+                with rpc('gateway.getObject'):
+                    ds_obj = conn.getObject('Dataset', ds_id)
+                refs.append(populate_dataset(ds_obj, frag, conn, reg))
     if datatype == 'Image':
-        populate_image(obj, ome, conn)
-    with open(filepath, 'w') as fp:
-        print(to_xml(ome), file=fp)
-        fp.close()
-    return
+        if bulk:
+            data = fetch_image_data(ids, conn)
+            refs = [populate_image_bulk(i, frag, data, reg) for i in ids]
+        else:
+            for i in ids:
+                with rpc('gateway.getObject'):
+                    img_obj = conn.getObject('Image', i)
+                refs.append(populate_image(img_obj, frag, conn, reg))
+    return frag, refs, reg.get('aliases', {})
+
+
+def _rename_refs(refs, aliases):
+    for ref in refs:
+        ref.id = aliases.get(ref.id, ref.id)
+
+
+def merge_fragment(ome, frag, reg, frag_aliases=None):
+    # annotations, ROIs and Images shared between fragments are only
+    # added once, by ID. With content dedup, refs inside the fragment
+    # are pointed at identical objects from earlier fragments, and the
+    # fragment's own aliases (`frag_aliases`) are kept in `reg`
+    aliases = {}
+    for ann in frag.structured_annotations:
+        first = register_content(ann, ome.structured_annotations, reg,
+                                 'annotations')
+        if first != ann.id:
+            aliases[ann.id] = first
+    for roi in frag.rois:
+        _rename_refs(roi.annotation_ref, aliases)
+        first = register_content(roi, ome.rois, reg, 'rois')
+        if first != roi.id:
+            aliases[roi.id] = first
+    for section, index in [('images', 'images'), ('datasets', 'datasets')]:
+        for obj in getattr(frag, section):
+            _rename_refs(obj.annotation_ref, aliases)
+            if section == 'images':
+                _rename_refs(obj.roi_ref, aliases)
+            register(obj, getattr(ome, section), reg[index])
+    if frag_aliases and 'aliases' in reg:
+        for alias, first in frag_aliases.items():
+            reg['aliases'].setdefault(alias, aliases.get(first, first))
+
+
+def extract_parallel(datatype, ids, ome, conn, reg, workers, bulk=False,
+                     stream=None):
+    """
+    Extracts Datasets (one per task) or Images (in chunks of
+    EXTRACT_CHUNK_SIZE) with a pool of `workers` threads, each using its
+    own session joined from `conn`. Fragments are merged into `ome` in
+    the order of `ids`, whichever worker finishes first, so the output
+    is the same as a serial run; at most 2 * `workers` of them are
+    extracted ahead of the one being merged. Returns the refs in order.
+    """
+    size = 1 if datatype == 'Dataset' else EXTRACT_CHUNK_SIZE
+    local = threading.local()
+    opened = []
+    # workers join the session on their own thread, where `conn` can't
+    # be used
+    uuid = conn.getSession().getUuid().val
+
+    def work(chunk):
+        if not hasattr(local, 'conn'):
+            local.conn = join_session(conn, uuid)
+            opened.append(local.conn)
+        return extract_fragment(datatype, chunk, local.conn, bulk,
+                                'aliases' in reg)
+
+    refs = []
+
+    def merge(future):
+        frag, chunk_refs, frag_aliases = future.result()
+        merge_fragment(ome, frag, reg, frag_aliases)
+        refs.extend(chunk_refs)
+        flush_stream(stream, ome)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            ahead = deque()
+            for chunk in _chunks(ids, size):
+                ahead.append(pool.submit(work, chunk))
+                if len(ahead) > 2 * workers:
+                    merge(ahead.popleft())
+            while ahead:
+                merge(ahead.popleft())
+    finally:
+        for worker in opened:
+            # the session belongs to `conn`, so it must not be killed
+            worker.close(hard=False)
+    return refs
+
+
+def open_stream(filepath):
+    # one temporary file per top-level OME section, next to the output
+    tmp_dir = tempfile.mkdtemp(prefix='.stream-',
+                               dir=os.path.dirname(os.path.abspath(filepath)))
+    return {'dir': tmp_dir,
+            'files': {s: open(os.path.join(tmp_dir, s), 'w+')
+                      for s in STREAM_SECTIONS},
+            'pending': {s: [] for s in STREAM_SECTIONS}}
+
+
+def _write_batch(stream, section):
+    # serializes pending objects through ome-types, then copies out
+    # the XML of each top-level element. The batch refers to objects in
+    # other sections (and batches), so it can't go through `OME()`,
+    # which links every reference to its object: `construct` skips that
+    objs = stream['pending'][section]
+    if not objs:
+        return
+    root = ElementTree.fromstring(to_xml(OME.construct(**{section: objs})))
+    elements = list(root)
+    if section == 'structured_annotations':
+        elements = list(elements[0])
+    fp = stream['files'][section]
+    for element in elements:
+        fp.write(ElementTree.tostring(element, encoding='unicode'))
+    objs.clear()
+
+
+def flush_stream(stream, ome):
+    # moves everything currently in `ome` to the stream, writing out
+    # full batches
+    if stream is None:
+        return
+    for section in STREAM_SECTIONS:
+        objs = getattr(ome, section)
+        stream['pending'][section].extend(objs)
+        objs.clear()
+        if len(stream['pending'][section]) >= STREAM_BATCH_SIZE:
+            _write_batch(stream, section)
+
+
+def close_stream(stream, filepath):
+    # assembles the sections, in schema order, into the final document
+    with open(filepath, 'w') as out:
+        out.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                  f'<OME xmlns="{OME_NS}" xmlns:xsi="{XSI_NS}"'
+                  f' xsi:schemaLocation="{OME_NS} {OME_NS}/ome.xsd">')
+        for section in STREAM_SECTIONS:
+            _write_batch(stream, section)
+            fp = stream['files'][section]
+            has_content = fp.tell() > 0
+            fp.seek(0)
+            if section == 'structured_annotations' and has_content:
+                out.write('<StructuredAnnotations>')
+            shutil.copyfileobj(fp, out)
+            if section == 'structured_annotations' and has_content:
+                out.write('</StructuredAnnotations>')
+            fp.close()
+        out.write('</OME>\n')
+    shutil.rmtree(stream['dir'], ignore_errors=True)
+
+
+def populate_xml(datatype, id, filepath, conn, bulk=False, stream=False,
+                 workers=1, dedup=False):
+    # with `stream`, objects are written to `filepath` as they are
+    # extracted instead of keeping the whole model in memory. With
+    # `workers` > 1, Datasets (or the Images of a Dataset) are extracted
+    # in parallel, each worker on its own joined session. With `dedup`,
+    # identical MapAnnotations and ROIs are written once; returns how
+    # many were folded away
+    ome = OME()
+    reg = create_registry(dedup)
+    xml_stream = open_stream(filepath) if stream else None
+    if bulk:
+        populate_bulk(datatype, id, ome, conn, reg, xml_stream, workers)
+    else:
+        obj = conn.getObject(datatype, id)
+        if datatype == 'Project':
+            populate_project(obj, ome, conn, reg, xml_stream, workers)
+        if datatype == 'Dataset':
+            populate_dataset(obj, ome, conn, reg, xml_stream, workers)
+        if datatype == 'Image':
+            populate_image(obj, ome, conn, reg)
+    if xml_stream is not None:
+        flush_stream(xml_stream, ome)
+        close_stream(xml_stream, filepath)
+    else:
+        with open(filepath, 'w') as fp:
+            print(to_xml(ome), file=fp)
+            fp.close()
+    stats = dedup_stats(reg)
+    if dedup:
+        print(f"Content dedup: {stats['MapAnnotation']} MapAnnotation(s)"
+              f" and {stats['ROI']} ROI(s) folded into identical ones.")
+    return stats
 
 
 if __name__ == "__main__":
@@ -386,7 +992,25 @@ if __name__ == "__main__":
     parser.add_argument('filepath',
                         type=str,
                         help='filepath to save xml')
+    parser.add_argument('--bulk',
+                        action='store_true',
+                        help='use batched queries to extract metadata')
+    parser.add_argument('--stream',
+                        action='store_true',
+                        help='write objects to the file as they are'
+                             ' extracted')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=1,
+                        help='number of parallel sessions used to extract'
+                             ' Datasets/Images')
+    parser.add_argument('--dedup',
+                        action='store_true',
+                        help='write identical MapAnnotations and ROIs'
+                             ' only once')
     args = parser.parse_args()
     conn = ezomero.connect()
-    populate_xml(args.datatype, args.id, args.filepath, conn)
+    populate_xml(args.datatype, args.id, args.filepath, conn,
+                 bulk=args.bulk, stream=args.stream, workers=args.workers,
+                 dedup=args.dedup)
     conn.close()
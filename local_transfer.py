@@ -0,0 +1,130 @@
+"""
+Zero-copy placement of files for the `local` transfer mode.
+
+`transfer_workflow.copy_local` runs this module as a script under
+`sudo -u <[data_storage] user>`, the same way rsync is run, so placed
+files and the directories holding them belong to that user:
+
+    python local_transfer.py MANIFEST [--same-fs]
+
+MANIFEST has one JSON `[source, destination]` pair per line. For each
+pair, one JSON `[source, method]` line is printed, with `method` null
+when the file could not be placed.
+"""
+import argparse
+import errno
+import fcntl
+import json
+import os
+import sys
+
+# ioctl request number for cloning a whole file (linux/fs.h)
+FICLONE = 0x40049409
+LOCAL_DIR_PERM = 0o755
+
+
+def _existing_parent(path):
+    # `path`, or its closest ancestor that exists
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def detect_shared_mount(local_repo, dest_dir):
+    """
+    Whether the source ManagedRepository is visible locally at
+    `local_repo`, and whether it sits on the same filesystem as
+    `dest_dir` (so files can be hardlinked instead of copied).
+    """
+    if not os.path.isdir(local_repo) or not os.access(local_repo, os.R_OK):
+        return {'readable': False, 'same_fs': False}
+    same_fs = (os.stat(local_repo).st_dev ==
+               os.stat(_existing_parent(dest_dir)).st_dev)
+    return {'readable': True, 'same_fs': same_fs}
+
+
+def _reflink(src, dest):
+    with open(src, 'rb') as s, open(dest, 'wb') as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+def _copy_range(src, dest):
+    # in-kernel copy: no bytes go through user space, and filesystems
+    # that support it (NFS 4.2, XFS, btrfs...) do it server-side or CoW
+    with open(src, 'rb') as s, open(dest, 'wb') as d:
+        remaining = os.fstat(s.fileno()).st_size
+        while remaining > 0:
+            n = os.copy_file_range(s.fileno(), d.fileno(), remaining)
+            if n == 0:
+                break
+            remaining -= n
+    if os.path.getsize(dest) != os.path.getsize(src):
+        raise OSError(errno.EIO, "short copy_file_range", dest)
+
+
+def _link(src, dest):
+    os.link(src, dest)
+
+
+def local_methods(mount):
+    # placement methods worth trying for a shared mount, cheapest first
+    methods = []
+    if mount['same_fs']:
+        methods.append(('hardlink', _link))
+    methods.append(('reflink', _reflink))
+    if hasattr(os, 'copy_file_range'):
+        methods.append(('copy_file_range', _copy_range))
+    return methods
+
+
+def place_file(src, dest, methods):
+    """
+    Puts `src` at `dest` with the first of `methods` that works,
+    replacing whatever was at `dest`. Returns the name of the method
+    used, or None if none worked (the caller should fall back to rsync).
+    """
+    try:
+        os.makedirs(os.path.dirname(dest), mode=LOCAL_DIR_PERM,
+                    exist_ok=True)
+        if os.path.exists(dest):
+            if os.path.samefile(src, dest):
+                return 'hardlink'
+            os.remove(dest)
+    except OSError:
+        # e.g. `src` missing, or no permission on the destination
+        return None
+    for name, method in methods:
+        try:
+            method(src, dest)
+            return name
+        except OSError:
+            # e.g. EXDEV, EOPNOTSUPP, ENOSYS, EPERM: try the next one
+            if os.path.lexists(dest):
+                os.remove(dest)
+    return None
+
+
+def place_manifest(manifest, same_fs, out=sys.stdout):
+    # places every pair listed in `manifest`, reporting each as it goes
+    methods = local_methods({'same_fs': same_fs})
+    with open(manifest) as fp:
+        for line in fp:
+            src, dest = json.loads(line)
+            out.write(json.dumps([src, place_file(src, dest, methods)])
+                      + "\n")
+            out.flush()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('manifest',
+                        type=str,
+                        help='file with one JSON [source, destination]'
+                             ' pair per line')
+    parser.add_argument('--same-fs',
+                        action='store_true',
+                        help='sources and destinations share a'
+                             ' filesystem, so try hardlinks first')
+    args = parser.parse_args()
+    place_manifest(args.manifest, args.same_fs)
@@ -0,0 +1,99 @@
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from omero.gateway import BlitzGateway
+
+# seconds between keepalive pings on pooled sessions
+KEEPALIVE_INTERVAL = 60
+
+
+def join_session(conn, uuid=None):
+    # a second gateway on the session of `conn`, for use from another
+    # thread (a single BlitzGateway should not be shared between threads).
+    # Joining from another thread than the one using `conn` needs the
+    # session `uuid`, read beforehand on that thread: getting it here is
+    # a server call through `conn`
+    if uuid is None:
+        uuid = conn.getSession().getUuid().val
+    worker = BlitzGateway(host=conn.host, port=conn.port,
+                          secure=conn.secure)
+    worker.connect(sUuid=uuid)
+    worker.SERVICE_OPTS.setOmeroGroup(conn.SERVICE_OPTS.getOmeroGroup())
+    return worker
+
+
+def open_pool(conn, size=1, keepalive=KEEPALIVE_INTERVAL):
+    """
+    Pool of gateways for writing to a server. With `size` > 1, `size`
+    sessions are joined from `conn` and independent saves are spread
+    across them by `pool_map`; `conn` itself is kept for the calling
+    thread. A background thread pings the session each `keepalive`
+    seconds, through a gateway of its own (all gateways here share the
+    one session), so it doesn't expire during long imports. `close_pool`
+    closes all of them, `conn` included, so the pool owns the connection
+    from here on.
+    """
+    conns = [join_session(conn) for _ in range(size)] if size > 1 else []
+    free = queue.Queue()
+    for worker in conns:
+        free.put(worker)
+    pool = {'main': conn, 'conns': conns, 'free': free,
+            'keeper': join_session(conn), 'stop': threading.Event(),
+            'executor': ThreadPoolExecutor(max_workers=max(len(conns), 1))}
+    pool['keepalive'] = threading.Thread(target=_keepalive,
+                                         args=(pool, keepalive),
+                                         daemon=True)
+    pool['keepalive'].start()
+    return pool
+
+
+def _keepalive(pool, interval):
+    # only touches its own gateway: the others are in use by other threads
+    while not pool['stop'].wait(interval):
+        try:
+            pool['keeper'].keepAlive()
+        except Exception as e:
+            print(f"Keepalive failed: {e}")
+
+
+def _run(pool, func, item):
+    # each task has a session to itself for as long as it runs
+    conn = pool['free'].get()
+    try:
+        return func(item, conn)
+    finally:
+        pool['free'].put(conn)
+
+
+def pool_map(func, items, conn, pool=None):
+    """
+    Yields `func(item, conn)` for every item, in order. With a pool
+    that has sessions of its own, calls run on those in parallel (at
+    most twice as many in flight as there are sessions, so `items` can
+    be a generator); otherwise they run here, one at a time, on `conn`.
+    Results are consumed in the calling thread, which is where any
+    journal writes should happen.
+    """
+    if pool is None or not pool['conns']:
+        for item in items:
+            yield func(item, conn)
+        return
+    window = deque()
+    depth = 2 * len(pool['conns'])
+    for item in items:
+        window.append(pool['executor'].submit(_run, pool, func, item))
+        if len(window) >= depth:
+            yield window.popleft().result()
+    while window:
+        yield window.popleft().result()
+
+
+def close_pool(pool):
+    pool['stop'].set()
+    pool['keepalive'].join()
+    pool['executor'].shutdown()
+    for worker in pool['conns'] + [pool['keeper']]:
+        # joined sessions are the main one: only close this gateway
+        worker.close(hard=False)
+    pool['main'].close()
@@ -0,0 +1,73 @@
+import warnings
+import numpy as np
+
+
+def _parse_numbers(text, expected):
+    # every number in `text`, as floats. `np.fromstring` stops at the
+    # first token it can't read with only a warning, so that warning and
+    # a short result both mean malformed input
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", DeprecationWarning)
+        try:
+            values = np.fromstring(text.replace(",", " "), sep=" ")
+        except DeprecationWarning as e:
+            raise ValueError(f"Malformed points: {e}") from None
+    if values.size != expected:
+        raise ValueError(f"Malformed points: read {values.size} numbers "
+                         f"instead of {expected}")
+    return values.reshape(-1, 2)
+
+
+def _count_pairs(points):
+    # each vertex is one whitespace-separated "x,y" token, trailing comma
+    # or not; anything else (e.g. "x, y") would shift vertices around
+    n_pairs = len(points.split())
+    if (len(points.replace(",", " ").split()) != 2 * n_pairs or
+            ",," in points or " ," in " " + points):
+        raise ValueError(f"Malformed points: {points!r}")
+    return n_pairs
+
+
+def parse_points(points):
+    """
+    Parses an OME/OMERO points string ("x1,y1 x2,y2 ...") into an (N, 2)
+    float array. Points sometimes come with a comma at the end
+    ("x1,y1, x2,y2,"), which is handled too. Raises ValueError on
+    anything else.
+    """
+    return _parse_numbers(points, 2 * _count_pairs(points))
+
+
+def parse_points_bulk(points_list):
+    """
+    Parses many points strings at once. Returns one contiguous (N, 2)
+    array with the vertices of every string, plus the offsets where
+    each string's vertices start (with the total count at the end), so
+    that string `i` is `coords[offsets[i]:offsets[i + 1]]`. Raises
+    ValueError if any string is malformed.
+    """
+    counts = np.fromiter((_count_pairs(p) for p in points_list),
+                         dtype=np.int64, count=len(points_list))
+    offsets = np.zeros(len(points_list) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    coords = _parse_numbers(" ".join(points_list), 2 * int(offsets[-1]))
+    return coords, offsets
+
+
+def _format_pairs(coords):
+    # float -> str is the expensive part; map/zip keeps it in C loops
+    values = np.asarray(coords, dtype=np.float64).ravel().tolist()
+    flat = list(map(repr, values))
+    return list(map(",".join, zip(flat[0::2], flat[1::2])))
+
+
+def format_points(coords):
+    # (N, 2) array -> "x1,y1 x2,y2 ..."
+    return " ".join(_format_pairs(coords))
+
+
+def format_points_bulk(coords, offsets):
+    # inverse of `parse_points_bulk`
+    pairs = _format_pairs(coords)
+    return [" ".join(pairs[offsets[i]:offsets[i + 1]])
+            for i in range(len(offsets) - 1)]
@@ -0,0 +1,7 @@
+import importlib.util
+
+# tests going through generate_xml/generate_omero_objects (on the fake
+# gateway in benchmarks/fake_omero.py) need omero-py and ome-types
+collect_ignore = []
+if not all(importlib.util.find_spec(m) for m in ['omero', 'ome_types']):
+    collect_ignore = ['test_stream_xml.py', 'test_stream_read.py']
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+from point_codec import parse_points, parse_points_bulk
+from point_codec import format_points, format_points_bulk
+
+
+def test_parse_points():
+    coords = parse_points("1,2 3.5,4 -5,6e2")
+    assert coords.tolist() == [[1, 2], [3.5, 4], [-5, 600]]
+
+
+def test_parse_points_trailing_comma():
+    assert parse_points("1,2, 3,4,").tolist() == [[1, 2], [3, 4]]
+
+
+def test_parse_points_empty():
+    assert parse_points("").shape == (0, 2)
+
+
+@pytest.mark.parametrize("points", ["1, 2 3, 4", "1,2 3", "1,2,3 4,5",
+                                    "1,2 a,b", "1,2 3,4x", "1,2 3,,4",
+                                    ",1,2"])
+def test_parse_points_malformed(points):
+    with pytest.raises(ValueError):
+        parse_points(points)
+
+
+def test_parse_points_bulk():
+    coords, offsets = parse_points_bulk(["1,2 3,4", "5,6,", "", "7,8 9,10"])
+    assert offsets.tolist() == [0, 2, 3, 3, 5]
+    assert coords.tolist() == [[1, 2], [3, 4], [5, 6], [7, 8], [9, 10]]
+
+
+@pytest.mark.parametrize("points_list", [["1,2", "3, 4 5, 6"],
+                                         ["1,2 3,4", "5,x"],
+                                         ["1,2", "3,4 5"]])
+def test_parse_points_bulk_malformed(points_list):
+    # a bad string must not shift vertices into its neighbours
+    with pytest.raises(ValueError):
+        parse_points_bulk(points_list)
+
+
+def test_format_round_trip():
+    points_list = ["1.5,2 3,4.25", "0.1,0.2, 0.3,0.4,"]
+    coords, offsets = parse_points_bulk(points_list)
+    assert format_points_bulk(coords, offsets) == ["1.5,2.0 3.0,4.25",
+                                                   "0.1,0.2 0.3,0.4"]
+    assert format_points(np.array([[1, 2]])) == "1.0,2.0"
@@ -0,0 +1,72 @@
+import pytest
+from collections import Counter
+from ome_types import from_xml
+from ome_types.model import TagAnnotation
+from generate_xml import populate_xml
+from generate_omero_objects import iter_xml, populate_omero
+from generate_omero_objects import populate_omero_stream
+from benchmarks.fake_omero import FakeGateway, create_store, make_project
+from benchmarks.fake_omero import add_images
+
+SECTIONS = ['projects', 'datasets', 'images', 'structured_annotations',
+            'rois']
+
+
+@pytest.fixture
+def xml_file(tmp_path):
+    store, proj_id = make_project(n_datasets=2, images_per_dataset=5,
+                                  n_tags=3, n_maps=3, rois_per_image=2)
+    fp = str(tmp_path / 'transfer.xml')
+    populate_xml('Project', proj_id, fp, FakeGateway(store), bulk=True)
+    return fp
+
+
+def test_iter_xml(xml_file):
+    # decode_element gives the same models as the full parser
+    ome = from_xml(xml_file)
+    items = list(iter_xml(xml_file))
+    for section in SECTIONS:
+        found = [obj for s, obj in items if s == section]
+        assert found == getattr(ome, section), section
+
+
+def test_iter_xml_sections(xml_file):
+    items = list(iter_xml(xml_file, validate=False, sections=['images']))
+    assert [s for s, _ in items] == ['images'] * 10
+
+
+@pytest.mark.parametrize("bulk", [False, True])
+def test_tag_fields(tmp_path, bulk):
+    # both extraction paths keep what `tag_key` matches tags on
+    store, proj_id = make_project(n_datasets=1, images_per_dataset=4,
+                                  n_tags=4, n_maps=0, rois_per_image=0)
+    fp = str(tmp_path / 'tags.xml')
+    populate_xml('Project', proj_id, fp, FakeGateway(store), bulk=bulk)
+    tags = {t.value: t for t in from_xml(fp).structured_annotations
+            if isinstance(t, TagAnnotation)}
+    assert tags['tag 1'].description == "description of tag 1"
+    assert tags['tag 1'].namespace == "example.org/tags"
+    assert tags['tag 2'].description is None
+    assert tags['tag 2'].namespace is None
+
+
+def transfer(fp, populate, **kwargs):
+    # runs `populate` on a fresh fake destination, leaving the last
+    # image out as if its import had failed
+    ome = from_xml(fp)
+    dest = FakeGateway(create_store())
+    dest_ids = add_images(dest._store, len(ome.images))
+    img_map = {img.id: i for img, i in zip(ome.images[:-1], dest_ids)}
+    populate(fp, img_map, dest, **kwargs)
+    return dest._store
+
+
+def test_populate_omero_stream(xml_file):
+    store = transfer(xml_file, populate_omero_stream, validate=False)
+    expected = transfer(xml_file, populate_omero)
+    assert (Counter(type(obj).__name__ for obj in store['saved']) ==
+            Counter(type(obj).__name__ for obj in expected['saved']))
+    assert ({k: len(v) for k, v in store['links'].items()} ==
+            {k: len(v) for k, v in expected['links'].items()})
+    assert len(store['links']['DatasetImageLink']) == 9
+    assert len(store['links']['ProjectDatasetLink']) == 2
@@ -0,0 +1,73 @@
+import pytest
+import generate_xml
+from ome_types import OME, from_xml, to_xml
+from ome_types.model import Map, Pixels, Polygon
+from ome_types.model.map import M
+from generate_xml import create_proj_and_ref, create_dataset_and_ref
+from generate_xml import create_image_and_ref, create_roi_and_ref
+from generate_xml import create_tag_and_ref, create_kv_and_ref
+from generate_xml import populate_xml
+from benchmarks.fake_omero import FakeGateway, make_project
+
+
+def small_model():
+    # one Project, one Dataset and three Images with annotations and ROIs,
+    # so every section refers to objects in other sections
+    ome = OME()
+    proj, _ = create_proj_and_ref(id=1, name="project")
+    ds, ds_ref = create_dataset_and_ref(id=2, name="dataset")
+    proj.dataset_ref.append(ds_ref)
+    tag, tag_ref = create_tag_and_ref(id=10, value="tag",
+                                      description="a tag")
+    proj.annotation_ref.append(tag_ref)
+    ome.structured_annotations.append(tag)
+    for i in range(3):
+        pixels = Pixels(id=i, dimension_order='XYZCT', size_c=1, size_t=1,
+                        size_x=8, size_y=8, size_z=1, type='uint8',
+                        metadata_only=True)
+        img, img_ref = create_image_and_ref(id=i, name=f"image {i}",
+                                            pixels=pixels)
+        kv, kv_ref = create_kv_and_ref(id=20 + i, value=Map(
+            m=[M(k='index', value=str(i))]))
+        ome.structured_annotations.append(kv)
+        img.annotation_ref.extend([tag_ref, kv_ref])
+        roi, roi_ref = create_roi_and_ref(id=30 + i, union=[
+            Polygon(id=40 + i, points="0,0 1,0 1,1")])
+        ome.rois.append(roi)
+        img.roi_ref.append(roi_ref)
+        ome.images.append(img)
+        ds.image_ref.append(img_ref)
+    ome.datasets.append(ds)
+    ome.projects.append(proj)
+    return ome
+
+
+def assert_same_model(ome, expected):
+    for section in generate_xml.STREAM_SECTIONS:
+        assert getattr(ome, section) == getattr(expected, section), section
+
+
+def test_stream_round_trip(tmp_path, monkeypatch):
+    # small batches, so sections are written in several pieces
+    monkeypatch.setattr(generate_xml, 'STREAM_BATCH_SIZE', 2)
+    fp = str(tmp_path / 'stream.xml')
+    stream = generate_xml.open_stream(fp)
+    generate_xml.flush_stream(stream, small_model())
+    generate_xml.close_stream(stream, fp)
+    assert_same_model(from_xml(fp), from_xml(to_xml(small_model())))
+
+
+@pytest.mark.parametrize("datatype", ['Project', 'Dataset'])
+@pytest.mark.parametrize("bulk", [False, True])
+def test_populate_xml_stream(tmp_path, monkeypatch, datatype, bulk):
+    monkeypatch.setattr(generate_xml, 'STREAM_BATCH_SIZE', 5)
+    monkeypatch.setattr(generate_xml, 'EXTRACT_CHUNK_SIZE', 3)
+    store, proj_id = make_project(n_datasets=2, images_per_dataset=7,
+                                  n_tags=3, n_maps=3, rois_per_image=2)
+    obj_id = proj_id if datatype == 'Project' else min(store['datasets'])
+    conn = FakeGateway(store)
+    full = str(tmp_path / 'full.xml')
+    streamed = str(tmp_path / 'stream.xml')
+    populate_xml(datatype, obj_id, full, conn, bulk=bulk)
+    populate_xml(datatype, obj_id, streamed, conn, bulk=bulk, stream=True)
+    assert_same_model(from_xml(streamed), from_xml(full))
@@ -0,0 +1,154 @@
+import os
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS steps (name TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS copied (path TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS imported (path TEXT, image_id INTEGER);
+CREATE INDEX IF NOT EXISTS imported_path ON imported (path);
+CREATE TABLE IF NOT EXISTS objects (kind TEXT, src_id TEXT, dest_id INTEGER,
+                                    PRIMARY KEY (kind, src_id));
+CREATE TABLE IF NOT EXISTS synced (kind TEXT, src_id TEXT, hash TEXT,
+                                   dest_id INTEGER,
+                                   PRIMARY KEY (kind, src_id));
+CREATE TABLE IF NOT EXISTS synced_filesets (fs_id INTEGER, src_image TEXT,
+                                            dest_image INTEGER);
+"""
+
+
+def journal_path(config):
+    # defaults to a SQLite file next to the XML
+    default = os.path.splitext(config['general']['xml_filepath'])[0]
+    return config['general'].get('journal_filepath',
+                                 default + '.journal.sqlite')
+
+
+def sync_path(config):
+    # the sync manifest outlives single runs, so it is kept apart from
+    # the journal (which a fresh run discards)
+    default = os.path.splitext(config['general']['xml_filepath'])[0]
+    return config['general'].get('sync_filepath', default + '.sync.sqlite')
+
+
+def open_journal(path, resume=False):
+    """
+    State journal for a transfer: which steps finished, which files were
+    copied and imported, and which objects were created destination-side.
+    Without `resume`, any previous journal at `path` is discarded.
+    All other helpers here do nothing when passed `None` as the journal.
+    """
+    if not resume and os.path.exists(path):
+        os.remove(path)
+    db = sqlite3.connect(path, check_same_thread=False)
+    db.executescript(SCHEMA)
+    return db
+
+
+def is_done(db, step):
+    if db is None:
+        return False
+    row = db.execute("SELECT 1 FROM steps WHERE name = ?", (step,))
+    return row.fetchone() is not None
+
+
+def mark_done(db, step):
+    if db is None:
+        return
+    with db:
+        db.execute("INSERT OR IGNORE INTO steps VALUES (?)", (step,))
+
+
+def get_copied(db):
+    if db is None:
+        return set()
+    return set(r[0] for r in db.execute("SELECT path FROM copied"))
+
+
+def mark_copied(db, files):
+    if db is None:
+        return
+    with db:
+        db.executemany("INSERT OR IGNORE INTO copied VALUES (?)",
+                       [(f,) for f in files])
+
+
+def get_imported(db):
+    # destination path -> sorted image IDs, same shape as `import_filesets`
+    if db is None:
+        return {}
+    dest_map = {}
+    for path, img_id in db.execute("SELECT path, image_id FROM imported"):
+        ids = dest_map.setdefault(path, [])
+        if img_id is not None:
+            ids.append(img_id)
+    return {k: sorted(v) for k, v in dest_map.items()}
+
+
+def mark_imported(db, dest_map):
+    if db is None:
+        return
+    rows = []
+    for path, img_ids in dest_map.items():
+        # a NULL row still records files that produced no images
+        rows.extend([(path, i) for i in img_ids] or [(path, None)])
+    with db:
+        db.executemany("DELETE FROM imported WHERE path = ?",
+                       [(p,) for p in dest_map])
+        db.executemany("INSERT INTO imported VALUES (?, ?)", rows)
+
+
+def load_objects(db, kind):
+    # source ID -> destination ID for objects of `kind` already created
+    if db is None:
+        return {}
+    rows = db.execute("SELECT src_id, dest_id FROM objects WHERE kind = ?",
+                      (kind,))
+    return {src: dest for src, dest in rows}
+
+
+def record_objects(db, kind, mapping):
+    if db is None:
+        return
+    with db:
+        db.executemany("INSERT OR REPLACE INTO objects VALUES (?, ?, ?)",
+                       [(kind, str(k), v) for k, v in mapping.items()])
+
+
+def load_synced(db, kind):
+    # source ID -> (content hash, destination ID) from previous syncs
+    if db is None:
+        return {}
+    rows = db.execute("SELECT src_id, hash, dest_id FROM synced"
+                      " WHERE kind = ?", (kind,))
+    return {src: (h, dest) for src, h, dest in rows}
+
+
+def record_synced(db, kind, mapping):
+    if db is None:
+        return
+    with db:
+        db.executemany("INSERT OR REPLACE INTO synced VALUES (?, ?, ?, ?)",
+                       [(kind, str(k), h, v)
+                        for k, (h, v) in mapping.items()])
+
+
+def load_synced_filesets(db):
+    # source fileset ID -> {source image: destination image ID}
+    if db is None:
+        return {}
+    fs_maps = {}
+    for fs_id, src, dest in db.execute("SELECT * FROM synced_filesets"):
+        fs_maps.setdefault(fs_id, {})[src] = dest
+    return fs_maps
+
+
+def record_synced_filesets(db, fs_maps):
+    if db is None:
+        return
+    with db:
+        db.executemany("DELETE FROM synced_filesets WHERE fs_id = ?",
+                       [(k,) for k in fs_maps])
+        db.executemany("INSERT INTO synced_filesets VALUES (?, ?, ?)",
+                       [(fs_id, src, dest)
+                        for fs_id, m in fs_maps.items()
+                        for src, dest in m.items()])
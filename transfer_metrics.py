@@ -0,0 +1,129 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# one report per process: stages, OMERO calls and transfer rates. Calls
+# can come from worker threads, hence the lock
+_lock = threading.Lock()
+_report = {}
+_debug = False
+# (start, end) of every `record_transfer` call, per transfer
+_spans = {}
+
+
+def report_path(config):
+    # defaults to a JSON file next to the XML
+    default = os.path.splitext(config['general']['xml_filepath'])[0]
+    return config['general'].get('report_filepath', default + '.report.json')
+
+
+def reset_report(debug=False):
+    global _debug
+    _debug = debug
+    with _lock:
+        _spans.clear()
+        _report.clear()
+        _report.update({'started': time.time(), 'stages': {}, 'rpcs': {},
+                        'transfers': {}})
+
+
+def debug(*args):
+    # verbose dumps (whole ID maps and the like), only with --debug
+    if _debug:
+        print(*args)
+
+
+@contextmanager
+def stage(name):
+    # times a stage of the workflow; a stage entered again adds up
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _lock:
+            _report.setdefault('stages', {})[name] = (
+                _report['stages'].get(name, 0) + elapsed)
+        print(f"{name} took {elapsed:.1f}s.")
+
+
+@contextmanager
+def rpc(name):
+    # counts and times one OMERO call of type `name`
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _lock:
+            calls = _report.setdefault('rpcs', {}).setdefault(
+                name, {'calls': 0, 'seconds': 0.0})
+            calls['calls'] += 1
+            calls['seconds'] += elapsed
+
+
+def record_transfer(name, n_bytes, n_files, seconds, n_filesets=0):
+    # bytes, files and filesets moved by the copy/import stages, just
+    # done in `seconds`; repeated calls for the same stage add up, and
+    # calls from parallel workers overlap (see `_wall_seconds`)
+    end = time.perf_counter()
+    with _lock:
+        t = _report.setdefault('transfers', {}).setdefault(
+            name, {'bytes': 0, 'files': 0, 'filesets': 0, 'seconds': 0.0})
+        t['bytes'] += n_bytes
+        t['files'] += n_files
+        t['filesets'] += n_filesets
+        t['seconds'] += seconds
+        _spans.setdefault(name, []).append((end - seconds, end))
+
+
+def _wall_seconds(spans):
+    # time covered by at least one of `spans`: with parallel workers,
+    # summed seconds count the same wall-clock time several times
+    total, reach = 0.0, None
+    for start, end in sorted(spans):
+        if reach is None or start > reach:
+            total += end - start
+            reach = end
+        elif end > reach:
+            total += end - reach
+            reach = end
+    return total
+
+
+def get_report():
+    # a copy of the report, with rates filled in
+    with _lock:
+        report = json.loads(json.dumps(_report))
+        spans = {k: list(v) for k, v in _spans.items()}
+    for name, t in report.get('transfers', {}).items():
+        # rates are per wall-clock second, whatever the number of workers
+        secs = _wall_seconds(spans.get(name, []))
+        t['wall_seconds'] = secs
+        for unit in ['bytes', 'files', 'filesets']:
+            t[f'{unit}_per_second'] = t[unit] / secs if secs > 0 else None
+    for calls in report.get('rpcs', {}).values():
+        calls['mean_seconds'] = calls['seconds'] / calls['calls']
+    if 'started' in report:
+        report['total_seconds'] = time.time() - report['started']
+    return report
+
+
+def write_report(path, **extra):
+    # `extra` goes in as-is (config summary, counts...)
+    report = get_report()
+    report.update(extra)
+    with open(path, 'w') as fp:
+        json.dump(report, fp, indent=2, sort_keys=True)
+    print(f"Run report saved at {path}.")
+    return report
+
+
+def load_report(path):
+    # a report written by an earlier run, or None
+    if not os.path.exists(path):
+        return None
+    with open(path) as fp:
+        return json.load(fp)
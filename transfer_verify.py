@@ -0,0 +1,81 @@
+import hashlib
+import mmap
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from transfer_metrics import record_transfer
+
+# OMERO checksum algorithms (OriginalFile.hasher) we can recompute here
+HASHERS = {'SHA1-160': hashlib.sha1, 'MD5-128': hashlib.md5}
+# files at least this big are hashed through mmap, smaller ones with
+# plain reads of HASH_BLOCK_SIZE bytes
+MMAP_MIN_SIZE = 64 * 1024 * 1024
+HASH_BLOCK_SIZE = 8 * 1024 * 1024
+
+
+def hash_file(path, hasher):
+    """
+    Checksum of a local file with one of HASHERS, read sequentially in
+    large blocks (or mapped in memory, for big files). Returns (path,
+    hex digest, bytes read); the digest is None if the file can't be read.
+    """
+    h = HASHERS[hasher]()
+    try:
+        with open(path, 'rb') as fp:
+            size = os.fstat(fp.fileno()).st_size
+            if size >= MMAP_MIN_SIZE:
+                with mmap.mmap(fp.fileno(), 0,
+                               access=mmap.ACCESS_READ) as mm:
+                    if hasattr(mm, 'madvise'):
+                        mm.madvise(mmap.MADV_SEQUENTIAL)
+                    h.update(mm)
+            else:
+                for block in iter(lambda: fp.read(HASH_BLOCK_SIZE), b''):
+                    h.update(block)
+    except OSError:
+        return path, None, 0
+    return path, h.hexdigest(), size
+
+
+def hash_executor(workers):
+    # worker processes are started from a fork server rather than forked
+    # from this process, which has Ice and pipeline threads running
+    return ProcessPoolExecutor(
+        max_workers=max(workers, 1),
+        mp_context=multiprocessing.get_context('forkserver'))
+
+
+def _hash_task(item):
+    path, hasher = item
+    return hash_file(path, hasher)
+
+
+def verify_hashes(expected, workers=1, executor=None):
+    """
+    Hashes local files in parallel processes and compares them with
+    `expected`, path -> (hasher, checksum) as OMERO stores them. Files
+    whose hasher is missing or not in HASHERS are not checked. Returns
+    the paths that don't match (unreadable ones included) and how many
+    files could not be checked. Hashing throughput goes in the run
+    report under 'verify'.
+    """
+    to_hash = [(p, hasher) for p, (hasher, h) in expected.items()
+               if hasher in HASHERS and h]
+    unchecked = len(expected) - len(to_hash)
+    start = time.perf_counter()
+    if executor is None:
+        with hash_executor(workers) as executor:
+            results = list(executor.map(_hash_task, to_hash, chunksize=4))
+    else:
+        results = list(executor.map(_hash_task, to_hash, chunksize=4))
+    elapsed = time.perf_counter() - start
+    n_bytes = sum(size for _, _, size in results)
+    record_transfer('verify', n_bytes, len(results), elapsed)
+    bad = [p for p, digest, _ in results
+           if digest is None or digest != expected[p][1].lower()]
+    rate = n_bytes / elapsed if elapsed > 0 else 0
+    print(f"Verified {len(results)} file(s), {n_bytes / 1e9:.2f} GB in "
+          f"{elapsed:.1f}s ({rate / 1e6:.1f} MB/s): {len(bad)} mismatch(es)"
+          f", {unchecked} without a usable source checksum.")
+    return bad, unchecked
@@ -2,20 +2,58 @@ import configparser
 import argparse
 import ezomero
 import getpass
+import hashlib
 import ome_types
 import os
 import pwd
 import grp
 import sys
 import subprocess
+import time
+import heapq
+import json
+import shutil
+import tempfile
+import threading
+import queue
+import math
+from itertools import chain
 from collections import defaultdict
-from generate_xml import populate_xml
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from generate_xml import populate_xml, bulk_projection, content_hash
+from generate_xml import QUERY_CHUNK_SIZE
 from omero.sys import Parameters
-from omero.rtypes import rstring
-from generate_omero_objects import populate_omero
+from omero.rtypes import rlist, rstring
+from generate_omero_objects import populate_omero, ROI_BATCH_SIZE
+from generate_omero_objects import create_containers, populate_images
+from generate_omero_objects import populate_omero_stream, iter_xml
+from generate_omero_objects import SAVE_CHUNK_SIZE, load_tag_cache
+from generate_omero_objects import per_image_rois
+from omero_pool import open_pool, close_pool, join_session
+import local_transfer
+from local_transfer import detect_shared_mount
+from transfer_metrics import stage, rpc, debug, record_transfer
+from transfer_metrics import reset_report, write_report, report_path
+from transfer_metrics import load_report
+from transfer_verify import verify_hashes, hash_executor
+from transfer_journal import open_journal, journal_path, is_done, mark_done
+from transfer_journal import get_copied, mark_copied
+from transfer_journal import get_imported, mark_imported
+from transfer_journal import load_objects, record_objects
+from transfer_journal import sync_path, load_synced, record_synced
+from transfer_journal import load_synced_filesets, record_synced_filesets
 
 #DIR_PERM = 0o755
 DIR_PERM = 755
+# filesets with more files than this are imported from their directory
+IMPORT_TARGET_LIMIT = 200
+# times a file failing verification is copied again
+VERIFY_RECOPIES = 1
+# in pipeline mode, filesets are copied in batches of up to this many
+# filesets or bytes, so small filesets share an rsync/SSH session
+COPY_BATCH_FILESETS = 50
+COPY_BATCH_BYTES = 1024 ** 3
 
 
 def demote(user_uid, user_gid, homedir):
@@ -78,169 +116,1280 @@ def get_destination_connection(config):
     return destconn
 
 
-def list_source_files(config, conn):
-    # go through all images in XML, create list of filepaths.
-    # return both a map between files and IDs and a simple list of files
+def get_destination_pool(config):
+    # the destination connection plus `dest_sessions` joined sessions
+    # for object creation and linking; `close_pool` closes all of them
+    destconn = get_destination_connection(config)
+    return open_pool(destconn, config['general'].getint('dest_sessions', 1))
+
+
+def get_source_filesets(img_ids, conn, client_fps, managedrepo_dir):
+    # batched queries for image -> fileset and fileset -> usedFiles,
+    # joined here (a single query would return images x files rows).
+    # returns fileset ID -> {'files', 'size', 'image_ids', 'series',
+    # 'hashes', 'hashers', 'sizes', 'hash', 'master'}, all in order;
+    # 'series' is each image's series index within the fileset,
+    # 'hashes', 'hashers' and 'sizes' each file's OriginalFile checksum,
+    # checksum algorithm and size, 'hash' the checksum of the whole
+    # fileset and 'master' the file it was imported from (the one its
+    # Pixels point to), or None if the server doesn't say
+    img_rows = bulk_projection("SELECT fs.id, i.id, i.series, p.path,"
+                               " p.name"
+                               " FROM Image i"
+                               " JOIN i.fileset fs"
+                               " LEFT OUTER JOIN i.pixels p"
+                               " WHERE i.id IN (:ids)", img_ids, conn)
+    filesets = {}
+    masters = {}
+    for fs_id, img_id, series, pix_path, pix_name in sorted(
+            img_rows, key=lambda r: r[:3]):
+        fs = filesets.setdefault(fs_id, {'files': [], 'size': 0,
+                                         'image_ids': [], 'series': {},
+                                         'hashes': {}, 'hashers': {},
+                                         'sizes': {}, 'master': None})
+        if img_id not in fs['series']:
+            fs['image_ids'].append(img_id)
+            fs['series'][img_id] = series or 0
+        if pix_path and pix_name:
+            masters.setdefault(fs_id, os.path.normpath(
+                os.path.join(pix_path, pix_name)))
+    file_rows = bulk_projection("SELECT fe.fileset.id, fe.id, fe.clientPath,"
+                                " o.path, o.name, o.size, o.hash, h.value"
+                                " FROM FilesetEntry fe"
+                                " JOIN fe.originalFile o"
+                                " LEFT OUTER JOIN o.hasher h"
+                                " WHERE fe.fileset.id IN (:ids)",
+                                sorted(filesets), conn)
+    for fs_id, _, cpath, path, name, size, h, hasher in sorted(
+            file_rows, key=lambda r: (r[0], r[1])):
+        fs = filesets[fs_id]
+        if client_fps:
+            f = '/' + cpath
+        else:
+            f = path + name
+        f = str(os.path.join(managedrepo_dir, '.', f))
+        if os.path.normpath(os.path.join(path, name)) == masters.get(fs_id):
+            fs['master'] = f
+        if f not in fs['sizes']:
+            fs['files'].append(f)
+            fs['size'] += size or 0
+            fs['hashes'][f] = h
+            fs['hashers'][f] = hasher
+            fs['sizes'][f] = size or 0
+    for fs in filesets.values():
+        fs['hash'] = fileset_hash(fs['hashes'].values())
+    return filesets
+
+
+def fileset_hash(file_hashes):
+    # one checksum for a whole fileset, from the (SHA1) checksums OMERO
+    # keeps for its files; None if any of them has no checksum
+    file_hashes = set(file_hashes)
+    if not file_hashes or None in file_hashes:
+        return None
+    return hashlib.sha1("\n".join(sorted(file_hashes)).encode()).hexdigest()
+
+
+def find_dest_filesets(filesets, destconn):
+    """
+    Batched checksum lookup on the destination server, for
+    `skip_existing`. Returns fileset checksum -> {series index: image
+    ID} for every source fileset with a destination fileset made of
+    exactly the same files (by content, not by name). Candidates are
+    found by the checksum of each source fileset's largest file, so that
+    common small files (empty ones, shared companion files) don't pull
+    in unrelated filesets, and narrowed down by number of files before
+    their files are fetched. When several destination filesets match,
+    the most recent import is used.
+    """
+    keys = defaultdict(set)
+    for fs in filesets.values():
+        # no checksum (or no files): nothing to match on
+        if not fs['hash']:
+            continue
+        largest = max(fs['files'], key=lambda f: fs['sizes'][f])
+        if fs['sizes'][largest] > 0:
+            keys[fs['hashes'][largest]].add(len(fs['files']))
+    wanted = set(fs['hash'] for fs in filesets.values() if fs['hash'])
+    key_list = sorted(keys)
+    q = destconn.getQueryService()
+    candidates = {}
+    for i in range(0, len(key_list), QUERY_CHUNK_SIZE):
+        chunk = key_list[i:i + QUERY_CHUNK_SIZE]
+        params = Parameters()
+        params.map = {"hashes": rlist([rstring(h) for h in chunk])}
+        with rpc('query.projection'):
+            results = q.projection(
+                "SELECT fe.fileset.id, o.hash FROM FilesetEntry fe"
+                " JOIN fe.originalFile o"
+                " WHERE o.hash IN (:hashes)",
+                params,
+                destconn.SERVICE_OPTS
+                )
+        candidates.update((r[0].val, r[1].val) for r in results)
+    counts = bulk_projection("SELECT fe.fileset.id, count(fe.id)"
+                             " FROM FilesetEntry fe"
+                             " WHERE fe.fileset.id IN (:ids)"
+                             " GROUP BY fe.fileset.id", sorted(candidates),
+                             destconn)
+    fs_ids = [fs_id for fs_id, n in counts
+              if n in keys[candidates[fs_id]]]
+    # files and images separately, rather than one row per pair of them
+    file_rows = bulk_projection("SELECT fe.fileset.id, o.hash"
+                                " FROM FilesetEntry fe"
+                                " JOIN fe.originalFile o"
+                                " WHERE fe.fileset.id IN (:ids)",
+                                sorted(fs_ids), destconn)
+    img_rows = bulk_projection("SELECT fs.id, i.id, i.series"
+                               " FROM Image i"
+                               " JOIN i.fileset fs"
+                               " WHERE fs.id IN (:ids)", sorted(fs_ids),
+                               destconn)
+    dest = {fs_id: {'hashes': set(), 'images': {}} for fs_id in fs_ids}
+    for fs_id, h in file_rows:
+        dest[fs_id]['hashes'].add(h)
+    for fs_id, img_id, series in img_rows:
+        dest[fs_id]['images'][series or 0] = img_id
+    found = {}
+    # later filesets overwrite earlier ones; filesets without images
+    # have nothing to reuse
+    for fs_id in sorted(dest):
+        key = fileset_hash(dest[fs_id]['hashes'])
+        if key in wanted and dest[fs_id]['images']:
+            found[key] = dest[fs_id]['images']
+    return found
+
+
+def list_source_files(config, conn, xml_file=None):
+    # go through all images in XML (`xml_filepath` by default), group
+    # their files by fileset. return a map between files and IDs, a
+    # simple list of files and the fileset groups themselves
     client_fps = config['source_omero'].getboolean('use_client_filepaths',
                                                    False)
     managedrepo_dir = config['source_server']['managedrepo_dir']
-    xml_file = config['general']['xml_filepath']
+    if xml_file is None:
+        xml_file = config['general']['xml_filepath']
+    if config['general'].getboolean('stream_read', False):
+        validate = not config['general'].getboolean('skip_xml_validation',
+                                                    False)
+        imgs = [img for _, img in iter_xml(xml_file, validate=validate,
+                                           sections=['images'])]
+    else:
+        imgs = ome_types.from_xml(xml_file).images
+    img_ids = [int(img.id.split(':')[-1]) for img in imgs]
+    filesets = get_source_filesets(img_ids, conn, client_fps,
+                                   managedrepo_dir)
+    d = {}
     filelist = []
-    file_img_tuples = []
-    ome = ome_types.from_xml(xml_file)
-    for img in ome.images:
-        img_id = int(img.id.split(':')[-1])
-        if client_fps:
-            img_files = ezomero.get_original_filepaths(conn, img_id,
-                                                       fpath='client')
-        else:
-            img_files = ezomero.get_original_filepaths(conn, img_id)
-        for f in img_files:
-            f = str(os.path.join(managedrepo_dir,'.', f))
-            file_img_tuples.append((f, img_id))
+    for fs in filesets.values():
+        for f in fs['files']:
+            d[f] = fs['image_ids']
             filelist.append(f)
-    d = defaultdict(list)
-    for k, v in file_img_tuples:
-        d[k].append(v)
-    d = {x: sorted(d[x]) for x in d.keys()}
-    filelist = (list(set(filelist)))
-    return d, filelist
+    return d, filelist, filesets
 
 
-def copy_files(filelist, config):
+def split_source_path(f):
+    # rsync relative paths start after a "/./" marker (see
+    # list_source_files); paths without one are relative to "/"
+    if '/./' in f:
+        root, rel = f.split('/./', 1)
+        return root + '/', rel
+    return '/', f.lstrip('/')
+
+
+def shard_filesets(filesets, n_shards):
+    # size-balanced shards of whole filesets: biggest filesets first,
+    # each one going to the currently smallest shard
+    shards = [(0, i, []) for i in range(n_shards)]
+    heapq.heapify(shards)
+    for fs in sorted(filesets.values(), key=lambda x: x['size'],
+                     reverse=True):
+        size, i, files = heapq.heappop(shards)
+        files.extend(fs['files'])
+        heapq.heappush(shards, (size + fs['size'], i, files))
+    return [(size, files) for size, _, files in sorted(shards,
+                                                       key=lambda x: x[1])
+            if files]
+
+
+def write_manifests(files, manifest_dir, shard_idx):
+    # one --files-from manifest per source root, readable by the
+    # local user running rsync
+    by_root = defaultdict(list)
+    for f in files:
+        root, rel = split_source_path(f)
+        by_root[root].append((f, rel))
+    manifests = []
+    for j, (root, entries) in enumerate(sorted(by_root.items())):
+        manifest = os.path.join(manifest_dir, f"shard{shard_idx}_{j}.txt")
+        with open(manifest, 'w') as fp:
+            fp.write("\n".join(rel for _, rel in entries) + "\n")
+        os.chmod(manifest, 0o644)
+        manifests.append((root, manifest, [f for f, _ in entries]))
+    return manifests
+
+
+def get_local_source_path(file, config):
+    # where a source file is visible locally, for `local` transfers
+    managed_repo = config['source_server']['managedrepo_dir']
+    local_repo = config['source_server'].get('local_managedrepo_dir',
+                                             managed_repo)
+    rel_path = file.split(managed_repo)[-1][1:]
+    return os.path.normpath(os.path.join(local_repo, rel_path))
+
+
+def copy_local(filesets, config, streams=None):
+    """
+    `local` transfer mode: when the source ManagedRepository is mounted
+    here, files are hardlinked (same filesystem), reflinked or copied
+    in-kernel with copy_file_range into the layout `get_dest_path` uses.
+    Like rsync, this runs as the [data_storage] user, in
+    `transfer_streams` processes of `local_transfer.py`, each placing
+    the files of its size-balanced shard of filesets (`streams`
+    overrides `transfer_streams`). Returns the files placed and the
+    filesets that still need rsync (all of them if the repository is
+    not visible locally).
+    """
+    managed_repo = config['source_server']['managedrepo_dir']
+    local_repo = config['source_server'].get('local_managedrepo_dir',
+                                             managed_repo)
+    dest_user = config['data_storage']['user']
+    dest_dir = config['data_storage']['data_directory']
+    mount = detect_shared_mount(local_repo, dest_dir)
+    if not mount['readable']:
+        print(f"{local_repo} is not readable here, using rsync.")
+        return [], filesets
+    if streams is None:
+        streams = config['general'].getint('transfer_streams', 1)
+    n_streams = max(streams, 1)
+    manifest_dir = tempfile.mkdtemp(prefix='omero-transfer-')
+    os.chmod(manifest_dir, 0o755)
+    start = time.perf_counter()
+    processes = []
+    for i, (_, files) in enumerate(shard_filesets(filesets, n_streams)):
+        manifest = os.path.join(manifest_dir, f"local{i}.jsonl")
+        with open(manifest, 'w') as fp:
+            for f in files:
+                fp.write(json.dumps([get_local_source_path(f, config),
+                                     get_dest_path(f, config)]) + "\n")
+        os.chmod(manifest, 0o644)
+        placecmd = ['sudo', '-u', dest_user, sys.executable,
+                    os.path.abspath(local_transfer.__file__), manifest]
+        if mount['same_fs']:
+            placecmd.append('--same-fs')
+        processes.append((subprocess.Popen(placecmd, stdout=subprocess.PIPE,
+                                           stderr=sys.stderr, text=True),
+                          files))
+    methods = {}
+    for process, files in processes:
+        out, _ = process.communicate()
+        src_files = {get_local_source_path(f, config): f for f in files}
+        for line in out.splitlines():
+            src, method = json.loads(line)
+            methods[src_files[src]] = method
+        if process.returncode != 0:
+            print(f"Local placement failed: {' '.join(process.args)}")
+    shutil.rmtree(manifest_dir, ignore_errors=True)
+
+    placed, n_bytes, used = [], 0, defaultdict(int)
+    rest = {}
+    for fs_id, fs in filesets.items():
+        fs_methods = [methods.get(f) for f in fs['files']]
+        for method in fs_methods:
+            used[method] += 1
+        if all(method is not None for method in fs_methods):
+            placed.extend(fs['files'])
+            n_bytes += fs['size']
+        else:
+            rest[fs_id] = fs
+    elapsed = time.perf_counter() - start
+    record_transfer('copy', n_bytes, len(placed), elapsed)
+    print(f"Placed {len(placed)} file(s) locally in {elapsed:.1f}s ("
+          + ", ".join(f"{n} by {m}" for m, n in sorted(used.items())
+                      if m is not None) + ").")
+    if rest:
+        print(f"{len(rest)} fileset(s) could not be placed locally,"
+              " using rsync for them.")
+    return placed, rest
+
+
+def copy_files(filesets, config, streams=None):
+    # copies whole filesets with `transfer_streams` (or `streams`) rsync
+    # processes in parallel, each reading its share of the files from a
+    # manifest.
+    # In `local` transfer mode files are placed without rsync where
+    # possible (see `copy_local`).
+    # returns the files whose copy finished successfully
+    placed = []
+    if config['general'].get('transfer_mode', 'rsync') == 'local':
+        placed, filesets = copy_local(filesets, config, streams)
+        if not filesets:
+            return placed
     source_user = config['source_server']['user']
     dest_user = config['data_storage']['user']
     dest_group = config['data_storage']['group']
     dest_dir = config['data_storage']['data_directory']
     source_host = config['source_omero']['hostname']
+    n_streams = streams or config['general'].getint('transfer_streams', 1)
     #os.makedirs(dest_dir, mode=DIR_PERM, exist_ok=True)
     mkdircmd = ['sudo', '-u', dest_user, 'mkdir', '-m', str(DIR_PERM), '-p', dest_dir]
     process = subprocess.Popen(mkdircmd,
                                stdout=sys.stdout,
                                stderr=sys.stderr
                                )
-    space_filelist = [s.replace(" ", "\ ") for s in filelist]
-    copycmd = ['sudo', '-u', dest_user, 'rsync', '-RvhL', '--progress',
-               source_user+"@"+source_host+":"+" ".join(space_filelist),
-               dest_dir+"/"]
-    process = subprocess.Popen(copycmd,
-                               stdout=sys.stdout,
-                               stderr=sys.stderr
-                               )
     process.communicate()
-    return
+    manifest_dir = tempfile.mkdtemp(prefix='omero-transfer-')
+    os.chmod(manifest_dir, 0o755)
+    shards = shard_filesets(filesets, max(n_streams, 1))
+    sizes = {f: fs['sizes'][f] for fs in filesets.values()
+             for f in fs['files']}
+    # progress output from several streams would be interleaved
+    progress = ['--progress'] if len(shards) == 1 else []
+    start = time.perf_counter()
+    processes = []
+    for i, (size, files) in enumerate(shards):
+        for root, manifest, m_files in write_manifests(files, manifest_dir,
+                                                       i):
+            copycmd = ['sudo', '-u', dest_user, 'rsync', '-vhL',
+                       *progress, f"--files-from={manifest}",
+                       source_user+"@"+source_host+":"+root,
+                       dest_dir+"/"]
+            processes.append((subprocess.Popen(copycmd,
+                                               stdout=sys.stdout,
+                                               stderr=sys.stderr
+                                               ), m_files))
+    copied = []
+    failed = []
+    for process, m_files in processes:
+        if process.wait() == 0:
+            copied.extend(m_files)
+        else:
+            failed.append((process.args, m_files))
+    elapsed = time.perf_counter() - start
+    shutil.rmtree(manifest_dir, ignore_errors=True)
+    # only what actually made it counts towards the throughput
+    copied_bytes = sum(sizes[f] for f in copied)
+    rate = copied_bytes / elapsed if elapsed > 0 else 0
+    record_transfer('copy', copied_bytes, len(copied), elapsed)
+    print(f"Copied {copied_bytes / 1e9:.2f} GB in {elapsed:.1f}s "
+          f"({rate / 1e6:.1f} MB/s) over {len(processes)} rsync stream(s).")
+    for cmd, m_files in failed:
+        print(f"rsync failed: {' '.join(cmd)}")
+        print(f"{len(m_files)} file(s) not copied:")
+        for f in m_files:
+            print(f"  {f}")
+    return placed + copied
+
+
+def remove_dest_files(paths, config):
+    # bad copies have to go before copying again, since rsync skips
+    # files whose size and time already match. rsync-ed files belong
+    # to the [data_storage] user
+    dest_user = config['data_storage']['user']
+    left = []
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            left.append(path)
+    for i in range(0, len(left), 500):
+        rmcmd = ['sudo', '-u', dest_user, 'rm', '-f', '--'] + left[i:i + 500]
+        subprocess.run(rmcmd, stdout=sys.stdout, stderr=sys.stderr)
+
 
+def is_hardlinked(file, config):
+    # `local` transfers may hardlink files: the copy is then the source
+    # file itself, and there is nothing to verify
+    try:
+        return os.path.samefile(get_local_source_path(file, config),
+                                get_dest_path(file, config))
+    except OSError:
+        return False
 
-def get_image_ids(file_path, destconn):
-    """Get the Ids of imported images.
+
+def verify_copies(filesets, copied, config, executor=None):
+    """
+    Checks the files of `filesets` in `copied` against the checksums the
+    source server keeps for them, hashing with `verify_workers`
+    processes (or `executor`). Files that don't match are removed and
+    copied again, up to VERIFY_RECOPIES times. Hardlinked files are not
+    checked. Returns the copied files that passed or could not be
+    checked, in order.
+    """
+    workers = config['general'].getint('verify_workers',
+                                       os.cpu_count() or 1)
+    files = {f: fs for fs in filesets.values() for f in fs['files']}
+    good = set(copied)
+    to_check = set(copied)
+    local = config['general'].get('transfer_mode', 'rsync') == 'local'
+    for attempt in range(VERIFY_RECOPIES + 1):
+        if local:
+            to_check = set(f for f in to_check
+                           if not is_hardlinked(f, config))
+        expected = {get_dest_path(f, config):
+                    (files[f]['hashers'][f], files[f]['hashes'][f])
+                    for f in to_check if f in files}
+        src = {get_dest_path(f, config): f for f in to_check}
+        bad_paths, _ = verify_hashes(expected, workers, executor)
+        bad = set(src[p] for p in bad_paths)
+        good -= bad
+        if not bad:
+            break
+        if attempt == VERIFY_RECOPIES:
+            print(f"{len(bad)} file(s) still don't match the source and "
+                  f"will not be imported:")
+            for f in sorted(bad):
+                print(f"  {f}")
+            break
+        print(f"{len(bad)} file(s) don't match the source, copying them "
+              f"again.")
+        remove_dest_files(bad_paths, config)
+        redo = {}
+        for fs_id, fs in filesets.items():
+            fs_bad = [f for f in fs['files'] if f in bad]
+            if fs_bad:
+                redo[fs_id] = dict(fs, files=fs_bad,
+                                   size=sum(fs['sizes'][f] for f in fs_bad))
+        to_check = set(copy_files(redo, config))
+        good |= to_check
+    return [f for f in copied if f in good]
+
+
+def get_image_ids(file_paths, destconn):
+    """Get the Ids of imported images for many files at once.
     Note that this will not find images if they have not been imported.
 
     Returns
     -------
-    image_ids : list of ints
-        Ids of images imported from the specified client path, which
-        itself is derived from ``file_path``.
+    dest_map : dict of lists of ints
+        Maps each of ``file_paths`` to the sorted Ids of the images
+        imported from the client path derived from it. Paths with no
+        images map to an empty list.
     """
     q = destconn.getQueryService()
-    params = Parameters()
-    path_query = str(file_path).strip('/')
-    params.map = {"cpath": rstring(path_query)}
-    results = q.projection(
-        "SELECT i.id FROM Image i"
-        " JOIN i.fileset fs"
-        " JOIN fs.usedFiles u"
-        " WHERE u.clientPath=:cpath",
-        params,
-        destconn.SERVICE_OPTS
-        )
-    image_ids = sorted([r[0].val for r in results])
-    return image_ids
-
-
-def import_files(filelist, destconn, config):
-    # import destination-side files as orphans
-    # create a map between files and image IDs
+    cpaths = {str(fp).strip('/'): fp for fp in file_paths}
+    dest_map = {fp: [] for fp in file_paths}
+    cpath_list = list(cpaths.keys())
+    for i in range(0, len(cpath_list), QUERY_CHUNK_SIZE):
+        chunk = cpath_list[i:i + QUERY_CHUNK_SIZE]
+        params = Parameters()
+        params.map = {"cpaths": rlist([rstring(c) for c in chunk])}
+        with rpc('query.projection'):
+            results = q.projection(
+                "SELECT DISTINCT u.clientPath, i.id FROM Image i"
+                " JOIN i.fileset fs"
+                " JOIN fs.usedFiles u"
+                " WHERE u.clientPath IN (:cpaths)",
+                params,
+                destconn.SERVICE_OPTS
+                )
+        for r in results:
+            dest_map[cpaths[r[0].val]].append(r[1].val)
+    return {fp: sorted(ids) for fp, ids in dest_map.items()}
+
+
+def get_dest_path(file, config):
+    # where a source file ends up locally after the copy
+    dest_dir = config['data_storage']['data_directory']
+    managed_repo = config['source_server']['managedrepo_dir']
+    rel_path = file.split(managed_repo)[-1][1:]
+    return os.path.join(dest_dir, rel_path)
+
+
+def import_targets(fs, config):
+    """
+    What to hand `omero import` for a whole fileset: its only file, or
+    all of its files so the importer picks the master file and imports
+    the fileset once (companion files are not imported on their own).
+    Filesets with more than IMPORT_TARGET_LIMIT files would not fit on
+    a command line: they are imported from their master file, which
+    the importer reads the companion files from, as it did on the
+    source server. Without a known master file, the directory holding
+    the fileset is used, but only if it holds nothing else (otherwise
+    other files would be imported with it); failing that, all files.
+    """
+    dest_paths = [get_dest_path(f, config) for f in fs['files']]
+    if len(dest_paths) <= IMPORT_TARGET_LIMIT:
+        return dest_paths
+    if fs.get('master'):
+        return [get_dest_path(fs['master'], config)]
+    common = os.path.commonpath(dest_paths)
+    found = set(os.path.join(root, name)
+                for root, _, names in os.walk(common) for name in names)
+    if found == set(os.path.normpath(p) for p in dest_paths):
+        return [common]
+    print(f"No master file known for a fileset of {len(dest_paths)} files"
+          f" in {common}, passing all of them to the importer.")
+    return dest_paths
+
+
+def build_import_cmd(targets, session, config):
     ln_s = config['general'].getboolean('ln_s_import', False)
     host = config['dest_omero']['hostname']
     port = int(config['dest_omero']['port'])
-    dest_dir = config['data_storage']['data_directory']
-    managed_repo = config['source_server']['managedrepo_dir']
+    if ln_s:
+        omero_user = config['general']['omero_user']
+        omero_path = config['general']['omero_path']
+        import_cmd = ['sudo', '-u', omero_user, omero_path, 'import',
+                      '-k', session, '-s', host, '-p', str(port),
+                      '--transfer', 'ln_s'] + [str(t) for t in targets]
+    else:
+        import_cmd = ['omero', 'import', '-k', session, '-s',
+                      host, '-p', str(port)] + [str(t) for t in targets]
+    return import_cmd
+
+
+def image_finder(fs, conn, lock, config):
+    # IDs of the images currently found for the files of `fs`, on a
+    # gateway that import threads share (hence the lock)
+    dest_paths = [get_dest_path(f, config) for f in fs['files']]
+
+    def find_images():
+        with lock:
+            found = get_image_ids(dest_paths, conn)
+        return set(chain.from_iterable(found.values()))
+    return find_images
+
+
+def run_import(import_cmd, retries, capture, find_images=None):
+    # runs a single import, retrying up to `retries` times on failure;
+    # returns exit status, number of attempts and elapsed seconds.
+    # an import can fail after the server created the fileset: with
+    # `find_images` (see `image_finder`), a failed import that left new
+    # images behind is not retried, since that would import it twice,
+    # and counts as imported. 'images' are then the (sorted) IDs of the
+    # images this import created, leaving out earlier imports of the
+    # same files
+    start = time.perf_counter()
+    before = find_images() if find_images is not None else set()
+    created = False
+    for attempt in range(1, retries + 2):
+        if attempt > 1 and find_images is not None:
+            created = bool(find_images() - before)
+            if created:
+                print(f"Import created images before failing, not "
+                      f"retrying: {' '.join(import_cmd[-1:])}")
+                attempt -= 1
+                break
+        if capture:
+            process = subprocess.run(import_cmd, stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT, text=True)
+        else:
+            process = subprocess.run(import_cmd, stdout=sys.stdout,
+                                     stderr=sys.stderr)
+        if process.returncode == 0:
+            break
+    images = None
+    if find_images is not None and (process.returncode == 0 or created):
+        images = sorted(find_images() - before)
+    return {'returncode': process.returncode,
+            'imported': process.returncode == 0 or created,
+            'attempts': attempt,
+            'seconds': time.perf_counter() - start,
+            'images': images,
+            'output': process.stdout if capture else None}
+
+
+def imported_images(fs, images, config):
+    # destination path -> image IDs for the files of a fileset, the way
+    # `mark_imported` and `make_image_map` take them
+    return {get_dest_path(f, config): images for f in fs['files']}
+
+
+def import_filesets(filesets, destconn, config):
+    # import destination-side filesets as orphans, one import per
+    # fileset, running up to `import_workers` imports at once with the
+    # same session. create a map between files and image IDs
+    workers = config['general'].getint('import_workers', 1)
+    retries = config['general'].getint('import_retries', 2)
     session = destconn.getSession().getUuid().val
+    # with several imports running at once their output is only
+    # shown when they fail, otherwise it would be interleaved
+    capture = workers > 1
+    results = {}
+    start = time.perf_counter()
+    checkconn = join_session(destconn)
+    lock = threading.Lock()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {}
+            for fs_id, fs in filesets.items():
+                import_cmd = build_import_cmd(import_targets(fs, config),
+                                              session, config)
+                futures[pool.submit(run_import, import_cmd, retries, capture,
+                                    image_finder(fs, checkconn, lock,
+                                                 config))] = fs_id
+            for future in as_completed(futures):
+                fs_id = futures[future]
+                result = future.result()
+                results[fs_id] = result
+                status = "ok" if result['imported'] else "FAILED"
+                print(f"Import {status} in {result['seconds']:.1f}s "
+                      f"({result['attempts']} attempt(s)): fileset {fs_id}, "
+                      f"{len(filesets[fs_id]['files'])} file(s)")
+                if result['returncode'] != 0 and result['output']:
+                    print(result['output'])
+    finally:
+        checkconn.close(hard=False)
+
+    failed = [k for k, r in results.items() if not r['imported']]
+    imported = [filesets[k] for k, r in results.items() if r['imported']]
+    record_transfer('import', sum(fs['size'] for fs in imported),
+                    sum(len(fs['files']) for fs in imported),
+                    time.perf_counter() - start, len(imported))
+    # every file of a fileset maps to all of the images its import
+    # created
     dest_map = {}
-    for file in filelist:
-        rel_path = file.split(managed_repo)[-1][1:]
-        dest_path = os.path.join(dest_dir, rel_path)
-        if ln_s:
-            omero_user = config['general']['omero_user']
-            omero_path = config['general']['omero_path']
-            import_cmd = ['sudo', '-u', omero_user, omero_path, 'import', 
-                          '-k', session, '-s', host, '-p', str(port),
-                          '--transfer', 'ln_s', str(dest_path)]
-        else:
-            import_cmd = ['omero', 'import', '-k', session, '-s',
-                          host, '-p', str(port), str(dest_path)]
-        print(import_cmd)
-        process = subprocess.Popen(import_cmd,
-                                   stdout=sys.stdout,
-                                   stderr=sys.stderr
-                                   )
-        process.communicate()
-
-        img_ids = get_image_ids(dest_path, destconn)
-        dest_map[dest_path] = img_ids
+    for fs_id, result in results.items():
+        if result['imported']:
+            dest_map.update(imported_images(filesets[fs_id],
+                                            result['images'], config))
+    if failed:
+        print(f"{len(failed)} fileset(s) failed to import after "
+              f"{retries + 1} attempt(s) and will not be linked:")
+        for fs_id in sorted(failed):
+            print(f"  {fs_id}: {filesets[fs_id]['files'][0]}")
     return dest_map
 
 
-def make_image_map(source_map, dest_map):
-    # using both source and destination file-to-image-id maps,
-    # map image IDs between source and destination
-    src_dict = defaultdict(list)
+def file_size(path):
+    # size of a local file, 0 if it can't be read
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def make_image_map(filesets, dest_map, config, dest_filesets=None):
+    # map image IDs between source and destination, fileset by fileset,
+    # by series index. Filesets are mapped to the images of their own
+    # import, found by path in `dest_map` (see `imported_images`), which
+    # come out in series order; with
+    # `dest_filesets` (see `find_dest_filesets`, for `skip_existing`),
+    # filesets are mapped by checksum to existing destination filesets
+    dest_filesets = dest_filesets or {}
     imgmap = {}
-    for k, v in source_map.items():
-        newkey = os.path.basename(k)
-        src_dict[newkey].extend(v)
-    dest_dict = defaultdict(list)
-    print(src_dict)
-    for k, v in dest_map.items():
-        newkey = os.path.basename(k)
-        dest_dict[newkey].extend(v)
-    print(dest_dict)
-    for src_k in src_dict.keys():
-        src_v = src_dict[src_k]
-        dest_v = dest_dict[src_k]
-        for count in range(len(src_v)):
-            map_key = f"Image:{src_v[count]}"
-            imgmap[map_key] = dest_v[count]
+    for fs_id, fs in filesets.items():
+        if fs['hash'] in dest_filesets:
+            by_series = dest_filesets[fs['hash']]
+        else:
+            dest_path = get_dest_path(fs['files'][0], config)
+            by_series = dict(enumerate(dest_map.get(dest_path, [])))
+        if not by_series:
+            continue
+        if not all(fs['series'][i] in by_series for i in fs['image_ids']):
+            print(f"Fileset {fs_id} is missing series at the destination, "
+                  f"not mapping it.")
+            continue
+        for img_id in fs['image_ids']:
+            imgmap[f"Image:{img_id}"] = by_series[fs['series'][img_id]]
+    debug(imgmap)
     return imgmap
 
 
-def main(configfile):
-    config = configparser.ConfigParser()
-    config.read(configfile)
+def skip_existing(filesets, destconn, journal, config):
+    # filesets already on the destination (same checksums) get their
+    # images mapped right away; returns the ones left to transfer
+    with stage('match_existing'):
+        dest_filesets = find_dest_filesets(filesets, destconn)
+        present = {k: fs for k, fs in filesets.items()
+                   if fs['hash'] in dest_filesets}
+        record_objects(journal, 'Image',
+                       make_image_map(present, {}, config, dest_filesets))
+    print(f"{len(present)} fileset(s) already on the destination, "
+          f"reusing their images.")
+    return {k: fs for k, fs in filesets.items() if k not in present}
+
+
+def run_pipeline(ome, filesets, destconn, config, journal=None, pool=None):
+    """
+    Moves each fileset through copy -> import -> ID resolution on its own,
+    with bounded queues between the stages, so copying, importing and
+    linking overlap. A dataset's ROIs and links are created as soon as
+    all of its images are mapped.
+    Only the resolver thread talks to `destconn` and `journal` (and hands
+    ROI and link saves to `pool`, if given). A copy or import that raises
+    fails its fileset only; if the resolver raises, the other stages are
+    stopped and drained before the error propagates.
+    """
+    n_copy = max(config['general'].getint('transfer_streams', 1), 1)
+    n_import = max(config['general'].getint('import_workers', 1), 1)
+    retries = config['general'].getint('import_retries', 2)
+    depth = config['general'].getint('pipeline_queue_size', 2 * n_import)
+    roi_batch_size = config['general'].getint('roi_batch_size',
+                                              ROI_BATCH_SIZE)
+    session = destconn.getSession().getUuid().val
+    n_verify = config['general'].getint('verify_workers',
+                                        os.cpu_count() or 1)
+    ds_map = load_objects(journal, 'Dataset')
+    ann_map = load_objects(journal, 'Annotation')
+
+    copied = get_copied(journal)
+    imported = get_imported(journal)
+    # created in the try block below, so that they're always closed
+    verify = checkconn = closer = None
+    check_lock = threading.Lock()
+    copy_q = queue.Queue()
+    import_q = queue.Queue(maxsize=depth)
+    resolve_q = queue.Queue(maxsize=depth)
+    # set when the resolver stops, for whatever reason: the other
+    # stages then stop taking work, and nothing blocks on a full queue
+    stop = threading.Event()
+    for fs_id, fs in filesets.items():
+        copy_q.put((fs_id, fs))
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def next_batch():
+        batch, size = {}, 0
+        while (len(batch) < COPY_BATCH_FILESETS and size < COPY_BATCH_BYTES
+               and not stop.is_set()):
+            try:
+                fs_id, fs = copy_q.get_nowait()
+            except queue.Empty:
+                break
+            batch[fs_id] = fs
+            size += fs['size']
+        return batch
+
+    def copier():
+        # copies a batch of filesets with a single rsync (there are
+        # already `transfer_streams` copiers), then hands them on one by
+        # one
+        while not stop.is_set():
+            batch = next_batch()
+            if not batch:
+                return
+            to_copy = {fs_id: fs for fs_id, fs in batch.items()
+                       if not set(fs['files']) <= copied}
+            new, error = [], None
+            try:
+                if to_copy:
+                    new = copy_files(to_copy, config, streams=1)
+                    if verify is not None:
+                        new = verify_copies(to_copy, new, config, verify)
+            except Exception as e:
+                new, error = [], f"copy failed: {e!r}"
+            new = set(new)
+            for fs_id, fs in batch.items():
+                fs_new = [f for f in fs['files'] if f in new]
+                fs_error = error if fs_id in to_copy else None
+                ok = fs_error is None and set(fs['files']) <= copied | new
+                put(import_q, (fs_id, fs, fs_new, ok, fs_error))
+
+    def importer():
+        while True:
+            try:
+                item = import_q.get(timeout=1)
+            except queue.Empty:
+                if stop.is_set():
+                    return
+                continue
+            if item is None:
+                return
+            fs_id, fs, new, ok, error = item
+            result = None
+            dest_paths = [get_dest_path(f, config) for f in fs['files']]
+            try:
+                if ok and not all(p in imported for p in dest_paths):
+                    import_cmd = build_import_cmd(import_targets(fs, config),
+                                                  session, config)
+                    result = run_import(import_cmd, retries, n_import > 1,
+                                        image_finder(fs, checkconn,
+                                                     check_lock, config))
+                    if result['imported']:
+                        record_transfer('import', fs['size'],
+                                        len(fs['files']), result['seconds'],
+                                        1)
+            except Exception as e:
+                result, error = None, f"import failed: {e!r}"
+            put(resolve_q, (fs_id, fs, new, ok, error, result))
+
+    workers = [threading.Thread(target=copier) for _ in range(n_copy)]
+    importers = [threading.Thread(target=importer) for _ in range(n_import)]
+
+    def finish_stages():
+        for t in workers:
+            t.join()
+        for _ in importers:
+            put(import_q, None)
+        for t in importers:
+            t.join()
+        put(resolve_q, None)
+
+    imgs = {img.id: img for img in ome.images}
+    pending = {ds.id: set(r.id for r in ds.image_ref) for ds in ome.datasets}
+    dss = {ds.id: ds for ds in ome.datasets}
+    # images already mapped by a previous (resumed or synced) run
+    img_map = load_objects(journal, 'Image')
+    linked = set()
+    per_image = per_image_rois(ome.images, config['general'].getboolean(
+        'dedup_content', False))
+
+    def link_dataset(ds_id):
+        new_imgs = [imgs[r.id] for r in dss[ds_id].image_ref
+                    if r.id in img_map and r.id not in linked]
+        populate_images(ome, new_imgs, [dss[ds_id]], ds_map, img_map,
+                        ann_map, destconn, roi_batch_size=roi_batch_size,
+                        journal=journal, pool=pool,
+                        per_image=per_image)
+        linked.update(img.id for img in new_imgs)
+
+    failed = []
+    try:
+        if config['general'].getboolean('verify_copies', False):
+            verify = hash_executor(n_verify)
+        checkconn = join_session(destconn)
+        for t in workers + importers:
+            t.start()
+        closer = threading.Thread(target=finish_stages)
+        closer.start()
+        while True:
+            item = resolve_q.get()
+            if item is None:
+                break
+            fs_id, fs, new, ok, error, result = item
+            mark_copied(journal, new)
+            if error is not None:
+                failed.append(fs_id)
+                print(f"Fileset {fs_id}: {error}, skipping it.")
+                continue
+            if not ok:
+                failed.append(fs_id)
+                print(f"Fileset {fs_id} was not fully copied, skipping it.")
+                continue
+            if result is not None:
+                if not result['imported']:
+                    failed.append(fs_id)
+                    print(f"Fileset {fs_id} failed to import, skipping it.")
+                    if result['output']:
+                        print(result['output'])
+                    continue
+                mark_imported(journal, imported_images(fs, result['images'],
+                                                       config))
+            fs_img_map = make_image_map({fs_id: fs}, get_imported(journal),
+                                        config)
+            record_objects(journal, 'Image', fs_img_map)
+            img_map.update(fs_img_map)
+            print(f"Fileset {fs_id} imported: {len(fs_img_map)} image(s).")
+            for ds_id in [k for k, v in pending.items()
+                          if v <= img_map.keys()]:
+                link_dataset(ds_id)
+                del pending[ds_id]
+    finally:
+        # on an error here, let the other stages wind down instead of
+        # leaving them blocked on queues nobody reads any more
+        stop.set()
+        while closer is not None and closer.is_alive():
+            for q in (copy_q, import_q, resolve_q):
+                try:
+                    while True:
+                        q.get_nowait()
+                except queue.Empty:
+                    pass
+            closer.join(timeout=0.1)
+        if checkconn is not None:
+            checkconn.close(hard=False)
+        if verify is not None:
+            verify.shutdown()
+
+    # datasets with images that never made it, and images outside datasets
+    for ds_id, ds_imgs in pending.items():
+        if not ds_imgs <= img_map.keys():
+            print(f"Dataset {ds_id} is missing images, linking the rest.")
+        link_dataset(ds_id)
+    orphans = [img for img in ome.images
+               if img.id in img_map and img.id not in linked]
+    populate_images(ome, orphans, [], ds_map, img_map, ann_map, destconn,
+                    roi_batch_size=roi_batch_size, journal=journal,
+                    pool=pool, per_image=per_image)
+    if failed:
+        print(f"{len(failed)} fileset(s) failed: {sorted(failed)}")
+    return img_map
+
+
+def prepare_sync(ome, filesets, sync, journal, reuse_tags=False):
+    """
+    Compares the current source subtree with the manifest of previous syncs.
+    Objects that did not change are seeded into the journal with their
+    destination IDs, so they are reused instead of created. Returns the
+    filesets that still need transferring and the destination IDs of
+    changed Annotations/ROIs, which get replaced. With `reuse_tags`,
+    changed Tags are matched again but never deleted, since the
+    destination tag may be shared with other data.
+    """
+    hashes = {'Annotation': {a.id: content_hash(a)
+                             for a in ome.structured_annotations},
+              'ROI': {r.id: content_hash(r) for r in ome.rois}}
+    for kind in ('Project', 'Dataset'):
+        record_objects(journal, kind, {k: v for k, (_, v)
+                                       in load_synced(sync, kind).items()})
+    shared = set()
+    if reuse_tags:
+        shared = set(a.id for a in ome.structured_annotations
+                     if isinstance(a, ome_types.model.TagAnnotation))
+    stale = {}
+    for kind, graph_type in (('Annotation', 'Annotation'), ('ROI', 'Roi')):
+        unchanged = {}
+        stale[graph_type] = []
+        for src, (h, dest) in load_synced(sync, kind).items():
+            # per-image copies of deduplicated ROIs are "ROI:1@dest_id"
+            src_id = src.split('@')[0]
+            if hashes[kind].get(src_id) == h:
+                unchanged[src] = dest
+            elif src_id in hashes[kind] and src_id not in shared:
+                stale[graph_type].append(dest)
+        record_objects(journal, kind, unchanged)
+        print(f"{kind}s: {len(unchanged)} unchanged, "
+              f"{len(stale[graph_type])} changed.")
+    synced_fs = load_synced_filesets(sync)
+    for fs_id, fs in filesets.items():
+        if fs_id in synced_fs:
+            record_objects(journal, 'Image', synced_fs[fs_id])
+    remaining = {k: fs for k, fs in filesets.items() if k not in synced_fs}
+    print(f"Filesets: {len(filesets) - len(remaining)} already transferred, "
+          f"{len(remaining)} new.")
+    return remaining, stale
+
+
+def delete_stale(stale, destconn, journal):
+    # removes destination copies of Annotations/ROIs that changed at the
+    # source; deleting an annotation also removes its links
+    if is_done(journal, 'sync_delete'):
+        return
+    for graph_type, ids in stale.items():
+        if ids:
+            with rpc('gateway.deleteObjects'):
+                destconn.deleteObjects(graph_type, ids, deleteAnns=False,
+                                       deleteChildren=False, wait=True)
+    mark_done(journal, 'sync_delete')
+
+
+def update_sync_manifest(ome, filesets, sync, journal):
+    # stores this run's source -> destination maps for the next sync
+    hashes = {'Annotation': {a.id: content_hash(a)
+                             for a in ome.structured_annotations},
+              'ROI': {r.id: content_hash(r) for r in ome.rois}}
+    for kind in ('Project', 'Dataset'):
+        record_synced(sync, kind, {k: (None, v) for k, v
+                                   in load_objects(journal, kind).items()})
+    for kind in ('Annotation', 'ROI'):
+        record_synced(sync, kind, {k: (hashes[kind][k.split('@')[0]], v)
+                                   for k, v
+                                   in load_objects(journal, kind).items()
+                                   if k.split('@')[0] in hashes[kind]})
+    img_map = load_objects(journal, 'Image')
+    fs_maps = {}
+    for fs_id, fs in filesets.items():
+        keys = [f"Image:{i}" for i in fs['image_ids']]
+        # only filesets that made it all the way count as transferred
+        if all(k in img_map for k in keys):
+            fs_maps[fs_id] = {k: img_map[k] for k in keys}
+    record_synced_filesets(sync, fs_maps)
+
+
+def count_objects(items):
+    # objects and links a transfer will create, from (section, object)
+    # pairs as `iter_xml` yields them
+    counts = defaultdict(int)
+    for section, obj in items:
+        counts[section] += 1
+        if section == 'projects':
+            counts['links'] += len(obj.dataset_ref) + len(obj.annotation_ref)
+        elif section == 'datasets':
+            counts['links'] += len(obj.image_ref) + len(obj.annotation_ref)
+        elif section == 'images':
+            counts['links'] += len(obj.annotation_ref)
+        elif section == 'rois':
+            counts['shapes'] += len(obj.union)
+    return dict(counts)
+
+
+def check_local_files(filesets, config):
+    # filesets whose files are all under data_directory already, with
+    # the same total size as at the source
+    present = set()
+    for fs_id, fs in filesets.items():
+        dest_paths = [get_dest_path(f, config) for f in fs['files']]
+        if (all(os.path.exists(p) for p in dest_paths) and
+                sum(file_size(p) for p in dest_paths) == fs['size']):
+            present.add(fs_id)
+    return present
+
+
+def estimate_seconds(plan, report, config):
+    # time per stage from the rates measured in an earlier run report
+    # (per wall-clock second, so they already include that run's
+    # parallelism); stages without a measurement are left out. Imports
+    # run one per fileset, so they go by filesets per second
+    estimate = {}
+    copy = report.get('transfers', {}).get('copy', {})
+    if copy.get('bytes_per_second'):
+        estimate['copy'] = plan['bytes_to_copy'] / copy['bytes_per_second']
+    imp = report.get('transfers', {}).get('import', {})
+    if imp.get('filesets_per_second'):
+        estimate['import'] = plan['filesets'] / imp['filesets_per_second']
+    rpcs = report.get('rpcs', {})
+    counts = plan['objects']
+    roi_batch_size = config['general'].getint('roi_batch_size',
+                                              ROI_BATCH_SIZE)
+    calls = {'ezomero.post_project': counts.get('projects', 0),
+             'gateway.save': (counts.get('datasets', 0) +
+                              counts.get('structured_annotations', 0)),
+             'update.saveAndReturnArray': math.ceil(
+                 counts.get('shapes', 0) / roi_batch_size),
+             'update.saveArray': math.ceil(
+                 counts.get('links', 0) / SAVE_CHUNK_SIZE)}
+    create = [n * rpcs[k]['mean_seconds'] for k, n in calls.items()
+              if k in rpcs]
+    if create:
+        sessions = max(config['general'].getint('dest_sessions', 1), 1)
+        estimate['create_and_link'] = sum(create) / sessions
+    return estimate
+
+
+def plan_transfer(config):
+    """
+    Dry run: builds the XML and lists source files as a real run would,
+    then reports filesets, files and bytes involved, how much is already
+    under data_directory, the objects and links to create, and a time
+    estimate based on the last run report. Nothing is copied, imported
+    or created, and no journal is touched: the XML goes to a temporary
+    file, so a run to be resumed keeps its own.
+    """
+    sourceconn = get_source_connection(config)
+    fd, xml_fp = tempfile.mkstemp(prefix='omero-transfer-plan-',
+                                  suffix='.xml')
+    os.close(fd)
+    try:
+        return _plan(config, sourceconn, xml_fp)
+    finally:
+        if os.path.exists(xml_fp):
+            os.remove(xml_fp)
+
+
+def _plan(config, sourceconn, xml_fp):
+    print("Populating xml...")
+    populate_xml(config['source_omero']['datatype'],
+                 config['source_omero']['id'], xml_fp, sourceconn,
+                 bulk=config['general'].getboolean('bulk_metadata', False),
+                 stream=config['general'].getboolean('stream_xml', False),
+                 workers=config['general'].getint('extract_workers', 1),
+                 dedup=config['general'].getboolean('dedup_content', False))
+    print("Listing source files...")
+    _, filelist, filesets = list_source_files(config, sourceconn, xml_fp)
+    sourceconn.close()
+
+    if config['general'].getboolean('stream_read', False):
+        items = iter_xml(xml_fp, validate=False)
+    else:
+        ome = ome_types.from_xml(xml_fp)
+        items = chain.from_iterable(
+            ((section, obj) for obj in getattr(ome, section))
+            for section in ['projects', 'datasets', 'images',
+                            'structured_annotations', 'rois'])
+    present = check_local_files(filesets, config)
+    total = sum(fs['size'] for fs in filesets.values())
+    plan = {'filesets': len(filesets), 'files': len(filelist),
+            'bytes': total,
+            'filesets_present': len(present),
+            'bytes_to_copy': total - sum(filesets[k]['size']
+                                         for k in present),
+            'objects': count_objects(items)}
+    report = load_report(report_path(config))
+    plan['estimate_seconds'] = (estimate_seconds(plan, report, config)
+                                if report else {})
+
+    print(f"{plan['filesets']} fileset(s), {plan['files']} file(s), "
+          f"{total / 1e9:.2f} GB.")
+    print(f"{len(present)} fileset(s) already under data_directory, "
+          f"{plan['bytes_to_copy'] / 1e9:.2f} GB left to copy.")
+    print("Objects to create: " + ", ".join(
+        f"{n} {k}" for k, n in sorted(plan['objects'].items())))
+    if not report:
+        print("No earlier run report found, so no time estimate.")
+    for step, secs in plan['estimate_seconds'].items():
+        print(f"Estimated {step}: {secs / 60:.1f} min")
+    if plan['estimate_seconds']:
+        print(f"Estimated total: "
+              f"{sum(plan['estimate_seconds'].values()) / 60:.1f} min")
+    return plan
+
+
+def run_transfer(config, run_info, resume=False, sync_mode=False):
+    # the whole transfer; counts for the run report go in `run_info`
+    journal = open_journal(journal_path(config), resume=resume)
+    sync = None
+    if sync_mode:
+        sync = open_journal(sync_path(config), resume=True)
 
     sourceconn = get_source_connection(config)
     src_datatype = config['source_omero']['datatype']
     src_dataid = config['source_omero']['id']
     xml_fp = config['general']['xml_filepath']
-    print("Populating xml...")
-    populate_xml(src_datatype, src_dataid, xml_fp, sourceconn)
-    print(f"XML saved at {xml_fp}.")
+    bulk = config['general'].getboolean('bulk_metadata', False)
+    stream = config['general'].getboolean('stream_xml', False)
+    extract_workers = config['general'].getint('extract_workers', 1)
+    dedup = config['general'].getboolean('dedup_content', False)
+    dedup_stats = None
+    if is_done(journal, 'xml') and os.path.exists(xml_fp):
+        print(f"Reusing XML at {xml_fp}.")
+    else:
+        print("Populating xml...")
+        with stage('xml'):
+            stats = populate_xml(src_datatype, src_dataid, xml_fp,
+                                 sourceconn, bulk=bulk, stream=stream,
+                                 workers=extract_workers, dedup=dedup)
+        if dedup:
+            dedup_stats = stats
+        mark_done(journal, 'xml')
+        print(f"XML saved at {xml_fp}.")
 
     print("Listing source files...")
-    src_file_id_map, filelist = list_source_files(config, sourceconn)
+    with stage('list_files'):
+        _, filelist, filesets = list_source_files(config, sourceconn)
     sourceconn.close()
+    reuse_tags = config['general'].getboolean('reuse_tags', False)
+    skip_present = config['general'].getboolean('skip_existing', False)
+    run_info.update(filesets=len(filesets), files=len(filelist))
+    if dedup_stats is not None:
+        run_info['dedup'] = dedup_stats
 
-    print("Starting file copy...")
-    copy_files(filelist, config)
+    all_filesets = filesets
+    stale = {}
+    if sync is not None:
+        print("Comparing with previous syncs...")
+        with stage('sync_compare'):
+            ome = ome_types.from_xml(xml_fp)
+            filesets, stale = prepare_sync(ome, filesets, sync, journal,
+                                           reuse_tags)
+            files = set(f for fs in filesets.values() for f in fs['files'])
+            filelist = [f for f in filelist if f in files]
 
-    print("Importing files...")
-    destconn = get_destination_connection(config)
-    dest_file_id_map = import_files(filelist, destconn, config)
-    img_map = make_image_map(src_file_id_map, dest_file_id_map)
+    if config['general'].getboolean('pipeline', False):
+        print("Creating OMERO containers...")
+        pool = get_destination_pool(config)
+        destconn = pool['main']
+        try:
+            with stage('containers'):
+                delete_stale(stale, destconn, journal)
+                ome = ome_types.from_xml(xml_fp)
+                tag_cache = load_tag_cache(destconn) if reuse_tags else None
+                create_containers(ome, destconn, journal, pool, tag_cache)
+            if skip_present:
+                filesets = skip_existing(filesets, destconn, journal, config)
+            print("Copying, importing and linking filesets...")
+            with stage('pipeline'):
+                img_map = run_pipeline(ome, filesets, destconn, config,
+                                       journal, pool)
+        finally:
+            close_pool(pool)
+        if sync is not None:
+            update_sync_manifest(ome, all_filesets, sync, journal)
+            sync.close()
+        journal.close()
+        run_info['images'] = len(img_map)
+        return
+
+    pool = get_destination_pool(config)
+    destconn = pool['main']
+    try:
+        if skip_present:
+            filesets = skip_existing(filesets, destconn, journal, config)
+
+        print("Starting file copy...")
+        with stage('copy'):
+            copied = get_copied(journal)
+            to_copy = {k: fs for k, fs in filesets.items()
+                       if not set(fs['files']) <= copied}
+            print(f"{len(filesets) - len(to_copy)} fileset(s) already copied.")
+            new = copy_files(to_copy, config)
+        if config['general'].getboolean('verify_copies', False):
+            print("Verifying copied files...")
+            with stage('verify'):
+                new = verify_copies(to_copy, new, config)
+        mark_copied(journal, new)
+
+        print("Importing files...")
+        with stage('import'):
+            delete_stale(stale, destconn, journal)
+            imported = get_imported(journal)
+            copied = get_copied(journal)
+            to_import = {k: fs for k, fs in filesets.items()
+                         if not all(get_dest_path(f, config) in imported
+                                    for f in fs['files'])}
+            print(f"{len(filesets) - len(to_import)} fileset(s) already "
+                  f"imported.")
+            missing = [k for k, fs in to_import.items()
+                       if not set(fs['files']) <= copied]
+            if missing:
+                print(f"{len(missing)} fileset(s) were not fully copied and "
+                      f"will not be imported: {sorted(missing)}")
+                to_import = {k: fs for k, fs in to_import.items()
+                             if k not in missing}
+            mark_imported(journal, import_filesets(to_import, destconn,
+                                                   config))
+            record_objects(journal, 'Image',
+                           make_image_map(filesets, get_imported(journal),
+                                          config))
+            img_map = load_objects(journal, 'Image')
 
-    print("Creating and linking OMERO objects...")
-    populate_omero(xml_fp, img_map, destconn)
-    destconn.close()
+        print("Creating and linking OMERO objects...")
+        roi_batch_size = config['general'].getint('roi_batch_size',
+                                                  ROI_BATCH_SIZE)
+        with stage('create_and_link'):
+            tag_cache = load_tag_cache(destconn) if reuse_tags else None
+            if config['general'].getboolean('stream_read', False):
+                validate = not config['general'].getboolean(
+                    'skip_xml_validation', False)
+                populate_omero_stream(xml_fp, img_map, destconn,
+                                      roi_batch_size=roi_batch_size,
+                                      journal=journal, validate=validate,
+                                      pool=pool, tag_cache=tag_cache,
+                                      dedup=dedup)
+            else:
+                populate_omero(xml_fp, img_map, destconn,
+                               roi_batch_size=roi_batch_size, journal=journal,
+                               pool=pool, tag_cache=tag_cache, dedup=dedup)
+    finally:
+        close_pool(pool)
+    if sync is not None:
+        update_sync_manifest(ome_types.from_xml(xml_fp), all_filesets, sync,
+                             journal)
+        sync.close()
+    journal.close()
+    run_info['images'] = len(img_map)
+
+
+def main(configfile, resume=False, sync_mode=False, debug_mode=False,
+         plan=False):
+    config = configparser.ConfigParser()
+    config.read(configfile)
+    if plan:
+        plan_transfer(config)
+        return
+    reset_report(debug=debug_mode)
+    run_info = {'datatype': config['source_omero']['datatype'],
+                'id': config['source_omero']['id'], 'resume': resume,
+                'sync': sync_mode, 'status': 'failed'}
+    # the report is written whatever happens: the timings of a run that
+    # crashed are the ones most worth having
+    try:
+        run_transfer(config, run_info, resume, sync_mode)
+        run_info['status'] = 'ok'
+    except BaseException as e:
+        run_info['error'] = repr(e)
+        raise
+    finally:
+        write_report(report_path(config), run=run_info)
 
 
 if __name__ == "__main__":
@@ -248,5 +1397,21 @@ if __name__ == "__main__":
     parser.add_argument('filepath',
                         type=str,
                         help='filepath to load config file')
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help='skip work already done by a previous run,'
+                             ' as recorded in its journal')
+    parser.add_argument('--sync',
+                        action='store_true',
+                        help='only transfer what is new or changed since'
+                             ' previous --sync runs')
+    parser.add_argument('--debug',
+                        action='store_true',
+                        help='print full ID maps and other verbose output')
+    parser.add_argument('--plan',
+                        action='store_true',
+                        help='only report what a transfer would move and'
+                             ' estimate how long it would take')
     args = parser.parse_args()
-    main(args.filepath)
+    main(args.filepath, resume=args.resume, sync_mode=args.sync,
+         debug_mode=args.debug, plan=args.plan)